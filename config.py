@@ -6,20 +6,31 @@ class ClipboardConfig:
     
     # 文件传输相关
     MAX_FILE_SIZE_AUTO = 100 * 1024 * 1024  # 100MB自动传输限制
-    CHUNK_SIZE = 700 * 1024  # 1MB分块大小
+    CHUNK_SIZE = 4 * 1024 * 1024  # 4MB分块大小 (每块一次 AES-GCM 调用)
+    LEGACY_CHUNK_SIZE = 700 * 1024  # 发给旧版对端的 JSON+base64 分块大小 (编码后小于其默认 1MB 消息上限)
+    MAX_CONCURRENT_CHUNKS = 2  # 发送流水线中预读的最大块数 (限制内存占用)
+    RECV_BUFFER_SIZE = CHUNK_SIZE + 64 * 1024  # 每个连接复用的解密缓冲区 (容纳一个完整的文件块帧)
+    FILE_BUNDLE_MAX_SIZE = 1024 * 1024  # 不超过此大小的文件合并发送，单条合并消息也以此为目标大小
+    CRYPTO_THREAD_THRESHOLD = 256 * 1024  # 超过此大小的消息在线程中加密，不阻塞事件循环
+    FILE_CACHE_SAVE_DELAY = 0.5  # 文件缓存写回延迟 (合并连续的缓存更新)
+    FILE_CACHE_EXISTS_TTL = 5.0  # 缓存文件存在性检查结果的有效期(秒)
     
     # 时间间隔配置
     MIN_PROCESS_INTERVAL = 0.8  # 最小处理间隔
     UPDATE_DELAY = 1.0  # 更新延迟
-    NETWORK_DELAY = 0.05  # 网络传输延迟
     CLIPBOARD_CHECK_INTERVAL = 0.5  # 剪贴板检查间隔
+    CLIPBOARD_OPEN_RETRIES = 5  # 剪贴板被其他应用占用 (拒绝访问) 时的重试次数
+    CLIPBOARD_RETRY_DELAY = 0.05  # 打开剪贴板重试间隔(秒)
     
     # 显示相关
     MAX_DISPLAY_LENGTH = 100  # 最大显示长度
+    PROGRESS_INTERVAL = 0.1  # 文件传输进度刷新的最小间隔(秒)
     
     # WebSocket配置
     DEFAULT_PORT = 8765
     HOST = "0.0.0.0"
+    MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # 单条WebSocket消息上限 (需容纳编码后的文件块)
+    WRITE_BUFFER_LIMIT = 2 * CHUNK_SIZE  # 发送缓冲区高水位: 上一块仍在排空时即可写入下一块，超过后 send 等待排空
     
     # 文件存储配置
     @classmethod
@@ -29,10 +40,9 @@ class ClipboardConfig:
         temp_dir.mkdir(exist_ok=True)
         return temp_dir
     
-    # 临时文件路径标识
-    TEMP_PATH_INDICATORS = [
+    # 临时文件路径标识 (不可变元组; 完整的 C:\\Users\\... 路径已被第一项覆盖)
+    TEMP_PATH_INDICATORS = (
         "\\AppData\\Local\\Temp\\clipshare_files\\",
         "/var/folders/",
         "/tmp/clipshare_files/",
-        "C:\\Users\\\\AppData\\Local\\Temp\\clipshare_files\\"
-    ]
\ No newline at end of file
+    )
\ No newline at end of file
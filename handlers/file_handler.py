@@ -1,14 +1,36 @@
 from pathlib import Path
+import blake3
 import hashlib
+import hmac
+import ipaddress
 import json
-import base64
+import logging
 import asyncio
+import collections
 import os
+import shutil
+import stat
 import time
 from utils.platform_config import IS_MACOS, IS_WINDOWS
-from utils.message_format import ClipMessage, MessageType
+from utils.message_format import ClipMessage, FILE_CHUNK_HEADER, b64decode
+from utils.security.crypto import NONCE_SIZE, TAG_SIZE
 from config import ClipboardConfig
 
+log = logging.getLogger(__name__)
+
+HAS_PWRITE = hasattr(os, "pwrite") # Not available on Windows
+HAS_FADVISE = hasattr(os, "posix_fadvise") # Linux only
+CACHE_LOG_MIN_COMPACT = 64 # Superseded cache log records tolerated before compacting
+
+PROGRESS_BAR_LENGTH = 20
+_PROGRESS_BARS = tuple('█' * filled + '░' * (PROGRESS_BAR_LENGTH - filled) for filled in range(PROGRESS_BAR_LENGTH + 1)) # Precomputed bars
+
+try:
+    import orjson # Faster cache (de)serialization, native bytes output
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 # Only import AppKit and objc on macOS
 if IS_MACOS:
     import AppKit
@@ -49,6 +71,13 @@ class FileHandler:
         self.security_mgr = security_mgr
         self.file_transfers = {}
         self.file_cache = {}
+        self._cache_save_handle = None  # Pending debounced save_file_cache call
+        self._pending_cache_records = []  # (hash, path | None) changes not yet appended to the cache log
+        self._cache_log_records = 0  # Records currently in the cache log (live + superseded)
+        self._cache_checked_until = {}  # path -> time.monotonic() until which it is known to exist
+        self._last_hashed_text = None  # Memo for text_hash: clipboard polls mostly see unchanged text
+        self._last_text_hash = None
+        self._pasteboard = AppKit.NSPasteboard.generalPasteboard() if IS_MACOS else None  # Reused across clipboard writes
         self._init_temp_dir()
         self.load_file_cache()
         self.chunk_size = ClipboardConfig.CHUNK_SIZE # Use config
@@ -67,48 +96,226 @@ class FileHandler:
                 return True
         return False
 
-    async def handle_file_transfer(self, file_path: str, send_encrypted_fn):
-        """处理文件传输（自动分块大文件）"""
+    @staticmethod
+    def _prefetch_file(file_path: str):
+        """提示内核开始预读整个文件 (POSIX_FADV_WILLNEED，不阻塞等待读取完成)"""
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            return # Missing files are reported by handle_file_transfer
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    async def handle_files_transfer(self, file_paths, send_encrypted_fn, bundle: bool = False, binary_chunks: bool = True):
+        """
+        依次传输多个文件; 发送当前文件时让内核预读下一个文件，使磁盘读取与加密/发送重叠.
+        bundle: 对端支持合并帧时，将小文件合并为一条消息发送 (一次加密、一次发送)
+        binary_chunks: 对端请求中声明可接收二进制文件块帧; 否则以旧版 JSON+base64 文件块发送
+        """
+        pending = [] # Frames of small files waiting to be bundled
+        pending_size = 0
+
+        async def flush():
+            nonlocal pending, pending_size
+            if pending:
+                if len(pending) > 1:
+                    print(f"📦 合并发送 {len(pending)} 个小文件 ({pending_size/1024:.1f}KB)")
+                await send_encrypted_fn(pending[0] if len(pending) == 1 else ClipMessage.file_bundle_frame(pending))
+            pending, pending_size = [], 0
+
+        for index, file_path in enumerate(file_paths):
+            if HAS_FADVISE and index + 1 < len(file_paths):
+                await asyncio.to_thread(self._prefetch_file, file_paths[index + 1])
+            frame = await asyncio.to_thread(self._small_file_frame, file_path) if bundle and binary_chunks else None
+            if frame is None:
+                await flush() # Keep files in request order
+                await self.handle_file_transfer(file_path, send_encrypted_fn, binary_chunks)
+                continue
+            pending.append(frame)
+            pending_size += len(frame)
+            if pending_size >= ClipboardConfig.FILE_BUNDLE_MAX_SIZE:
+                await flush()
+        await flush()
+
+    @staticmethod
+    def _small_file_frame(file_path: str):
+        """将不超过 FILE_BUNDLE_MAX_SIZE 的文件读成单个文件块帧; 其他情况返回 None (在线程中执行)"""
+        path_obj = Path(file_path)
+        try:
+            if not path_obj.is_file() or path_obj.stat().st_size > ClipboardConfig.FILE_BUNDLE_MAX_SIZE:
+                return None
+            data = path_obj.read_bytes()
+            file_hash = ClipMessage.calculate_file_hash(str(path_obj))
+        except OSError:
+            return None # Let handle_file_transfer report the error
+        print(f"📤 开始传输文件: {path_obj.name} ({len(data)/1024:.1f}KB, 合并发送)")
+        return ClipMessage.file_chunk_frame(path_obj.name, 0, 1, len(data), 0, data, file_hash)
+
+    async def handle_file_transfer(self, file_path: str, send_encrypted_fn, binary_chunks: bool = True):
+        """
+        处理文件传输（自动分块大文件）.
+        有 security_mgr 时文件块在读取线程中组帧并加密，以 send_encrypted_fn(data, encrypted=True) 直接发送，
+        使下一块的读取/加密与当前块的网络发送重叠.
+        binary_chunks 为 False 时 (旧版对端) 改用 JSON+base64 文件块.
+        """
         path_obj = Path(file_path)
         MAX_CHUNK_SIZE = self.chunk_size # Use instance chunk size
 
-        if not path_obj.exists() or not path_obj.is_file():
+        if not path_obj.is_file():
             print(f"⚠️ 文件不存在或无效: {file_path}")
+            # 控制回复仍使用 JSON: 告知请求方该文件不可用
+            try:
+                await send_encrypted_fn(ClipMessage.serialize(ClipMessage.file_unavailable_message(path_obj)))
+            except Exception as e:
+                print(f"❌ 发送文件不存在回复失败: {e}")
             return False
 
+        if not binary_chunks:
+            return await self._send_legacy_chunks(path_obj, send_encrypted_fn)
+
         try:
             file_size = path_obj.stat().st_size
-            total_chunks = (file_size + MAX_CHUNK_SIZE - 1) // MAX_CHUNK_SIZE
+            total_chunks = max(1, (file_size + MAX_CHUNK_SIZE - 1) // MAX_CHUNK_SIZE) # Empty files still send one chunk
             print(f"📤 开始传输文件: {path_obj.name} ({file_size/1024/1024:.1f}MB, {total_chunks}块)")
 
-            # 发送文件开始消息 (optional, could be part of the first chunk)
-            # Consider if a separate start message is needed or if info can be in first chunk
+            # 每块都相同的字段只计算一次
+            name_bytes = path_obj.name.encode('utf-8')
+            file_hash = await asyncio.to_thread(ClipMessage.calculate_file_hash, str(path_obj))
+
+            # 文件块直接读入帧缓冲区 (readinto，不经 mmap: 传输中文件被截断时只会读到较短的数据，而不是 SIGBUS)
+            with open(path_obj, 'rb', buffering=0) as f:
+                if HAS_FADVISE:
+                    try:
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL) # Hint the kernel to read ahead
+                    except OSError:
+                        pass
+
+                pre_encrypt = self.security_mgr is not None
+                name_end = FILE_CHUNK_HEADER.size + len(name_bytes)
+                frame_size = name_end + min(file_size, MAX_CHUNK_SIZE)
+                # 加密时复用缓冲区: 明文帧只在读取线程中使用一次，密文缓冲区在发送完成后归还到池中
+                plain_buffer = bytearray(frame_size) if pre_encrypt and total_chunks > 1 else None
+                send_buffers = collections.deque()
+
+                def build_frame(chunk_index):
+                    """读取一块到帧缓冲区、组帧并加密 (在线程中执行，读盘和加密都不阻塞事件循环)"""
+                    offset = chunk_index * MAX_CHUNK_SIZE
+                    chunk_len = min(MAX_CHUNK_SIZE, max(file_size - offset, 0)) # Never read past the size we announced
+                    buffer = plain_buffer if plain_buffer is not None else bytearray(name_end + chunk_len)
+                    with memoryview(buffer) as view:
+                        read = self._read_chunk(f, view[name_end:name_end + chunk_len], offset)
+                        if not read and chunk_index > 0:
+                            return None # File shrank since stat()
+                        frame_len = ClipMessage.pack_file_chunk_header(
+                            view,
+                            name_bytes,
+                            chunk_index,
+                            total_chunks,
+                            file_size,
+                            offset,
+                            read,
+                            file_hash if chunk_index == 0 else None # Send full hash only once
+                        )
+                        if plain_buffer is not None:
+                            out = send_buffers.popleft() if send_buffers else bytearray(NONCE_SIZE + frame_size + TAG_SIZE)
+                            return out, self.security_mgr.encrypt_message_into(view[:frame_len], out)
+                    del buffer[frame_len:] # Short read: file shrank while sending
+                    return self.security_mgr.encrypt_message(buffer) if pre_encrypt else buffer
+
+                # 读取+加密 / 发送流水线: 读取任务提前准备后续块，队列深度限制内存占用
+                frames = asyncio.Queue(maxsize=ClipboardConfig.MAX_CONCURRENT_CHUNKS)
+                stop_reading = False
+
+                async def read_frames():
+                    try:
+                        for chunk_index in range(total_chunks):
+                            if stop_reading:
+                                return
+                            frame = await asyncio.to_thread(build_frame, chunk_index)
+                            await frames.put(frame)
+                            if frame is None:
+                                return
+                    except Exception as e:
+                        await frames.put(e) # Surface reader errors to the sender
+
+                reader = asyncio.create_task(read_frames())
+                last_progress = 0.0
+                last_percent = -1
+                try:
+                    for chunk_index in range(total_chunks):
+                        frame = await frames.get()
+                        if frame is None:
+                            break
+                        if isinstance(frame, Exception):
+                            raise frame
+
+                        # 显示进度 (仅在百分比变化时且限频，避免每块一次终端写入)
+                        percent = (chunk_index + 1) * 100 // total_chunks
+                        if percent != last_percent:
+                            now = time.monotonic()
+                            if now - last_progress >= ClipboardConfig.PROGRESS_INTERVAL or chunk_index == total_chunks - 1:
+                                last_progress, last_percent = now, percent
+                                progress = self._format_progress(chunk_index + 1, total_chunks)
+                                print(f"\r📤 传输文件 {path_obj.name}: {progress}", end="", flush=True)
+
+                        # 加密并发送块 (websocket.send 在写缓冲区超过 write_limit 时等待排空，自带背压)
+                        if isinstance(frame, tuple):
+                            out, encrypted = frame
+                            await send_encrypted_fn(encrypted, encrypted=True)
+                            send_buffers.append(out) # websocket.send copies the payload into the outgoing frame
+                        elif pre_encrypt:
+                            await send_encrypted_fn(frame, encrypted=True)
+                        else:
+                            await send_encrypted_fn(frame)
+                finally:
+                    # Let the reader finish its current chunk (never cancel it mid-read) before closing the file
+                    stop_reading = True
+                    while not frames.empty():
+                        frames.get_nowait()
+                    await reader
+
+            print(f"\n✅ 文件 {path_obj.name} 传输完成")
+            return True
+
+        except Exception as e:
+            print(f"\n❌ 文件传输失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+
+    async def _send_legacy_chunks(self, path_obj: Path, send_encrypted_fn) -> bool:
+        """以旧版 JSON+base64 文件块发送 (旧版对端解密后按 UTF-8 JSON 解析，无法处理二进制帧，且按MD5校验文件)"""
+        chunk_size = ClipboardConfig.LEGACY_CHUNK_SIZE
+        try:
+            file_size = path_obj.stat().st_size
+            total_chunks = max(1, (file_size + chunk_size - 1) // chunk_size)
+            print(f"📤 开始传输文件: {path_obj.name} ({file_size/1024/1024:.1f}MB, {total_chunks}块, 兼容模式)")
+            file_hash = await asyncio.to_thread(ClipMessage.calculate_legacy_file_hash, str(path_obj))
 
-            # 逐块读取并发送文件
             with open(path_obj, 'rb') as f:
+                last_progress = 0.0
+                last_percent = -1
                 for chunk_index in range(total_chunks):
-                    chunk_data = f.read(MAX_CHUNK_SIZE)
-                    if not chunk_data:
-                        break
-
-                    chunk_msg = {
-                        'type': MessageType.FILE_RESPONSE,
-                        'filename': path_obj.name,
-                        'exists': True,
-                        'chunk_data': base64.b64encode(chunk_data).decode('utf-8'),
-                        'chunk_index': chunk_index,
-                        'total_chunks': total_chunks,
-                        'chunk_hash': hashlib.md5(chunk_data).hexdigest(),
-                        'file_hash': ClipMessage.calculate_file_hash(str(path_obj)) if chunk_index == 0 else None # Send full hash only once
-                    }
-
-                    # 显示进度
-                    progress = self._format_progress(chunk_index + 1, total_chunks)
-                    print(f"\r📤 传输文件 {path_obj.name}: {progress}", end="", flush=True)
-
-                    # 加密并发送块
-                    await send_encrypted_fn(json.dumps(chunk_msg).encode('utf-8'))
-                    await asyncio.sleep(ClipboardConfig.NETWORK_DELAY) # Use config
+                    chunk_data = await asyncio.to_thread(f.read, chunk_size)
+                    if not chunk_data and chunk_index > 0:
+                        break # File shrank since stat()
+                    message = ClipMessage.legacy_file_chunk_message(
+                        path_obj.name, chunk_index, total_chunks, chunk_data,
+                        file_hash if chunk_index == 0 else None # Send full hash only once
+                    )
+                    # 显示进度 (与二进制分块相同: 仅在百分比变化时且限频)
+                    percent = (chunk_index + 1) * 100 // total_chunks
+                    if percent != last_percent:
+                        now = time.monotonic()
+                        if now - last_progress >= ClipboardConfig.PROGRESS_INTERVAL or chunk_index == total_chunks - 1:
+                            last_progress, last_percent = now, percent
+                            progress = self._format_progress(chunk_index + 1, total_chunks)
+                            print(f"\r📤 传输文件 {path_obj.name}: {progress}", end="", flush=True)
+                    await send_encrypted_fn(await asyncio.to_thread(ClipMessage.serialize, message))
 
             print(f"\n✅ 文件 {path_obj.name} 传输完成")
             return True
@@ -129,88 +336,90 @@ class FileHandler:
 
     def _format_progress(self, current: int, total: int) -> str:
         """格式化进度显示"""
-        if total <= 0: return "[░░░░░░░░░░░░░░░░░░░░] 0% (0/0)" # Avoid division by zero
+        if total <= 0: return f"[{_PROGRESS_BARS[0]}] 0% (0/0)" # Avoid division by zero
         percentage = (current * 100) // total
-        bar_length = 20
-        filled = min(bar_length, (percentage * bar_length) // 100) # Ensure filled doesn't exceed bar_length
-        bar = '█' * filled + '░' * (bar_length - filled)
-        return f"[{bar}] {percentage}% ({current}/{total})"
+        filled = min(PROGRESS_BAR_LENGTH, (percentage * PROGRESS_BAR_LENGTH) // 100) # Ensure filled doesn't exceed bar_length
+        return f"[{_PROGRESS_BARS[filled]}] {percentage}% ({current}/{total})"
 
-    def handle_received_chunk(self, message: dict) -> tuple[bool, Path | None]:
+    async def handle_received_chunk(self, message: dict) -> tuple[bool, Path | None]:
         """
-        处理接收到的文件块.
+        处理接收到的文件块 (二进制帧或旧版 JSON+base64 消息).
+        磁盘预分配、写入和校验都在线程中执行，不阻塞事件循环.
         Returns: (is_complete, file_path_if_complete)
         """
         try:
             filename = message.get("filename", "unknown")
+            if message.get("exists") is False:
+                print(f"⚠️ 对端文件不存在: {filename}")
+                return False, None
             chunk_index = message.get("chunk_index", 0)
             total_chunks = message.get("total_chunks", 1)
-            chunk_data = base64.b64decode(message.get("chunk_data", ""))
-            chunk_hash = message.get("chunk_hash")
+            chunk_data = message.get("chunk_data", "")
+            if isinstance(chunk_data, str):
+                chunk_data = b64decode(chunk_data) # Legacy JSON chunk from older peers
             file_hash = message.get("file_hash") # Full file hash (sent with first chunk)
 
-            if not chunk_data:
+            if not chunk_data and message.get("file_size") != 0:
                 print("⚠️ 收到的文件块数据为空")
                 return False, None
 
-            # 验证块的完整性
-            if chunk_hash and hashlib.md5(chunk_data).hexdigest() != chunk_hash:
-                print(f"⚠️ 块 {chunk_index+1}/{total_chunks} 校验失败 for {filename}")
-                # Optionally request retransmission here
-                return False, None
-
             save_path = self.temp_dir / filename
 
             # Initialize transfer state if first chunk
             if filename not in self.file_transfers:
-                self.file_transfers[filename] = {
-                    "received_chunks": {}, # Store data by index
-                    "total_chunks": total_chunks,
-                    "path": save_path,
-                    "file_hash": file_hash # Store the expected full hash
-                }
-                # Clear any old file with the same name
-                if save_path.exists():
-                    try:
-                        save_path.unlink()
-                    except OSError as e:
-                        print(f"⚠️ 无法删除旧文件 {save_path}: {e}")
-
+                self.file_transfers[filename] = await asyncio.to_thread(
+                    self._open_transfer, save_path, total_chunks, message.get("file_size"), len(chunk_data), file_hash
+                )
 
             transfer = self.file_transfers[filename]
 
-            # Store chunk data if not already received
-            if chunk_index not in transfer["received_chunks"]:
-                 transfer["received_chunks"][chunk_index] = chunk_data
+            # 直接写入目标文件的对应偏移处
+            if not 0 <= chunk_index < transfer["total_chunks"]:
+                print(f"⚠️ 文件块序号无效: {chunk_index+1}/{transfer['total_chunks']} for {filename}")
+                return False, None
+            if not transfer["received"][chunk_index]:
+                offset = message.get("offset")
+                if offset is None:
+                    offset = chunk_index * transfer["chunk_stride"] # Legacy chunks carry no offset
+                end = offset + len(chunk_data)
+                if end > transfer["capacity"]:
+                    raise IOError(f"Chunk {chunk_index+1} exceeds file size for {filename}")
+                await asyncio.to_thread(self._store_chunk, transfer, chunk_data, offset)
+                transfer["size"] = max(transfer["size"], end)
+                transfer["received"][chunk_index] = 1
+                transfer["received_count"] += 1
             else:
-                 print(f"ℹ️ 收到重复块 {chunk_index+1}/{total_chunks} for {filename}")
-
-
-            # Display progress
-            progress = self._format_progress(len(transfer["received_chunks"]), transfer["total_chunks"])
-            print(f"\r📥 接收文件 {filename}: {progress}", end="", flush=True)
-
+                log.debug("ℹ️ 收到重复块 %d/%d for %s", chunk_index + 1, total_chunks, filename)
 
             # 检查是否完成
-            is_complete = len(transfer["received_chunks"]) == transfer["total_chunks"]
+            is_complete = transfer["received_count"] == transfer["total_chunks"]
+
+            # Display progress (only when the percentage changes, rate-limited; always show the final state)
+            percent = transfer["received_count"] * 100 // transfer["total_chunks"]
+            if percent != transfer["progress_percent"]:
+                now = time.monotonic()
+                if is_complete or now - transfer["progress_at"] >= ClipboardConfig.PROGRESS_INTERVAL:
+                    transfer["progress_at"], transfer["progress_percent"] = now, percent
+                    progress = self._format_progress(transfer["received_count"], transfer["total_chunks"])
+                    print(f"\r📥 接收文件 {filename}: {progress}", end="", flush=True)
 
             if is_complete:
-                print(f"\n✅ 文件 {filename} 所有块接收完成，开始组装...")
-                # 组装文件
+                print(f"\n✅ 文件 {filename} 所有块接收完成")
                 try:
-                    with open(save_path, "wb") as f:
-                        for i in range(transfer["total_chunks"]):
-                            if i in transfer["received_chunks"]:
-                                f.write(transfer["received_chunks"][i])
-                            else:
-                                # This shouldn't happen if is_complete is true, but as a safeguard
-                                print(f"❌ 组装文件 {filename} 时缺少块 {i+1}")
-                                raise IOError(f"Missing chunk {i+1} for {filename}")
-
-                    # 验证完整文件哈希
+                    self._close_transfer(transfer)
+                    if transfer["size"] != transfer["capacity"]:
+                        os.truncate(save_path, transfer["size"]) # Trim legacy over-allocation
+
+                    # 验证完整文件哈希 (块按顺序到达时已增量计算，无需重新读取文件)
+                    if transfer["hashed_size"] == transfer["size"]:
+                        actual_hash = transfer["hasher"].hexdigest()
+                    elif transfer["file_hash"]:
+                        actual_hash = await asyncio.to_thread(ClipMessage.hash_file_like, str(save_path), transfer["file_hash"])
+                    else:
+                        actual_hash = await asyncio.to_thread(ClipMessage.calculate_file_hash, str(save_path), False)
+
                     if transfer["file_hash"]:
-                        actual_hash = ClipMessage.calculate_file_hash(str(save_path))
-                        if actual_hash == transfer["file_hash"]:
+                        if hmac.compare_digest(actual_hash, transfer["file_hash"]):
                             print(f"✅ 文件 {filename} 哈希校验成功")
                         else:
                             print(f"❌ 文件 {filename} 哈希校验失败! Expected: {transfer['file_hash']}, Got: {actual_hash}")
@@ -223,7 +432,7 @@ class FileHandler:
 
 
                     # Add to cache (using the verified hash if available)
-                    final_hash = transfer["file_hash"] or ClipMessage.calculate_file_hash(str(save_path))
+                    final_hash = transfer["file_hash"] or actual_hash
                     self.add_to_file_cache(final_hash, str(save_path))
 
                     # 清理传输状态
@@ -232,7 +441,7 @@ class FileHandler:
                     return True, completed_path # Indicate completion and return path
 
                 except Exception as e:
-                    print(f"❌ 组装或校验文件 {filename} 失败: {e}")
+                    print(f"❌ 校验文件 {filename} 失败: {e}")
                     # Clean up
                     if save_path.exists(): save_path.unlink(missing_ok=True)
                     if filename in self.file_transfers: del self.file_transfers[filename]
@@ -244,32 +453,173 @@ class FileHandler:
             print(f"❌ 处理文件块失败: {e}")
             import traceback
             traceback.print_exc()
+            transfer = self.file_transfers.pop(message.get("filename", "unknown"), None)
+            if transfer:
+                self._close_transfer(transfer)
             return False, None # Indicate failure
 
+    def _open_transfer(self, save_path: Path, total_chunks: int, file_size, first_chunk_len: int, file_hash):
+        """预分配目标文件，后续文件块直接按偏移写入 (无需在内存中缓存整个文件)"""
+        if file_size is None:
+            # Legacy chunks have no size/offset: all chunks but the last share the first chunk's length
+            capacity = total_chunks * first_chunk_len
+        else:
+            capacity = file_size
+
+        f = open(save_path, "w+b", buffering=0) # Truncates any old file with the same name
+        try:
+            if capacity and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, capacity) # Reserve real blocks up front
+                except OSError:
+                    f.truncate(capacity) # Filesystem without fallocate support
+            else:
+                f.truncate(capacity)
+        except Exception:
+            f.close()
+            raise
+
+        return {
+            "file": f,
+            "received": bytearray(total_chunks), # 1 byte per chunk: received flag
+            "received_count": 0,
+            "total_chunks": total_chunks,
+            "capacity": capacity,
+            "chunk_stride": first_chunk_len,
+            "size": 0,
+            "hasher": ClipMessage.new_file_hasher(file_hash), # Running hash over in-order chunks
+            "hashed_size": 0,
+            "progress_at": 0.0, # time.monotonic() of the last progress print
+            "progress_percent": -1, # Percentage shown by the last progress print
+            "path": save_path,
+            "file_hash": file_hash # Store the expected full hash
+        }
+
+    def _store_chunk(self, transfer: dict, data, offset: int):
+        """写入文件块; 若块紧接在已哈希数据之后则同时更新增量哈希 (在线程中执行)"""
+        if data:
+            self._write_chunk(transfer["file"], data, offset)
+        if offset == transfer["hashed_size"]:
+            transfer["hasher"].update(data)
+            transfer["hashed_size"] += len(data)
+
+    @staticmethod
+    def _read_chunk(f, view, offset: int) -> int:
+        """从 offset 处读满 view 或读到文件末尾，返回读取的字节数 (在线程中执行)"""
+        f.seek(offset)
+        read = 0
+        while read < len(view):
+            count = f.readinto(view[read:])
+            if not count:
+                break # EOF: file shrank while sending
+            read += count
+        return read
+
+    @staticmethod
+    def _write_chunk(f, data, offset: int):
+        """将文件块写入指定偏移 (POSIX 使用 pwrite，一次系统调用且不移动文件指针)"""
+        if HAS_PWRITE:
+            view = memoryview(data)
+            while view: # Regular files rarely short-write, but never drop the tail if they do
+                written = os.pwrite(f.fileno(), view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            f.seek(offset)
+            f.write(data)
+
+    @staticmethod
+    def _close_transfer(transfer: dict):
+        """关闭传输使用的文件句柄"""
+        transfer["file"].close()
+
     # Removed _verify_file_integrity as validation is now part of handle_received_chunk
 
     # --- File Cache Methods ---
+    # 缓存以追加日志保存: 每行一条 JSON 记录 [hash, path] (path 为 null 表示删除)，
+    # 新增条目只追加一行；失效记录过多时整体压缩重写
     def load_file_cache(self):
-        """加载文件缓存"""
-        cache_path = self.temp_dir / "filecache.json"
+        """加载文件缓存 (重放追加日志; 兼容旧版 filecache.json)"""
+        log_path = self.temp_dir / "filecache.log"
+        legacy_path = self.temp_dir / "filecache.json"
+        self.file_cache = {}
+        self._cache_log_records = 0
         try:
-            if cache_path.exists():
-                with open(cache_path, "r") as f:
-                    self.file_cache = json.load(f)
+            if log_path.exists():
+                torn = False
+                # Compaction keeps the log small: read it in one call instead of buffered line-by-line reads
+                for line in log_path.read_bytes().splitlines():
+                    try:
+                        file_hash, path = orjson.loads(line) if HAS_ORJSON else json.loads(line)
+                    except (ValueError, TypeError):
+                        torn = True # Torn last line after a crash
+                        continue
+                    self._cache_log_records += 1
+                    if path is None:
+                        self.file_cache.pop(file_hash, None)
+                    else:
+                        self.file_cache[file_hash] = path
+                if torn:
+                    self._compact_file_cache() # Never append after a partial line
+                self._prune_file_cache()
+                print(f"📚 已加载 {len(self.file_cache)} 个文件缓存条目")
+            elif legacy_path.exists():
+                data = legacy_path.read_bytes()
+                self.file_cache = orjson.loads(data) if HAS_ORJSON else json.loads(data)
+                self._prune_file_cache()
+                self._compact_file_cache() # Migrate to the append-only log
+                legacy_path.unlink()
                 print(f"📚 已加载 {len(self.file_cache)} 个文件缓存条目")
             else:
-                self.file_cache = {}
                 print("📝 创建新的文件缓存")
         except Exception as e:
             print(f"⚠️ 加载文件缓存失败: {e}")
             self.file_cache = {}
 
+    def _prune_file_cache(self):
+        """丢弃指向已不存在文件的缓存条目 (一次 scandir 代替逐条 stat)"""
+        with os.scandir(self.temp_dir) as entries:
+            temp_files = {entry.name for entry in entries}
+        temp_dir = str(self.temp_dir)
+        stale = [
+            file_hash for file_hash, path in self.file_cache.items()
+            if not (os.path.basename(path) in temp_files if os.path.dirname(path) == temp_dir else os.path.exists(path))
+        ]
+        for file_hash in stale:
+            del self.file_cache[file_hash]
+            self._pending_cache_records.append((file_hash, None))
+        if stale:
+            print(f"🧹 清理 {len(stale)} 个无效缓存条目")
+            self.save_file_cache()
+
+    @staticmethod
+    def _encode_cache_records(records) -> bytes:
+        """将 (hash, path) 记录编码为日志行"""
+        if HAS_ORJSON:
+            return b"".join(orjson.dumps(record) + b"\n" for record in records)
+        return "".join(json.dumps(record) + "\n" for record in records).encode('utf-8')
+
+    def _compact_file_cache(self):
+        """用当前缓存内容重写日志 (先写临时文件再原子替换，避免崩溃时留下半写的缓存)"""
+        log_path = self.temp_dir / "filecache.log"
+        tmp_path = log_path.with_suffix(".tmp")
+        tmp_path.write_bytes(self._encode_cache_records(self.file_cache.items()))
+        os.replace(tmp_path, log_path)
+        self._cache_log_records = len(self.file_cache)
+
     def save_file_cache(self):
-        """保存文件缓存信息"""
-        cache_path = self.temp_dir / "filecache.json"
+        """保存文件缓存: 追加尚未写入的变更; 失效记录超过一半时压缩重写"""
+        if self._cache_save_handle is not None:
+            self._cache_save_handle.cancel()
+            self._cache_save_handle = None
+        records, self._pending_cache_records = self._pending_cache_records, []
         try:
-            with open(cache_path, "w") as f:
-                json.dump(self.file_cache, f)
+            if self._cache_log_records + len(records) > 2 * len(self.file_cache) + CACHE_LOG_MIN_COMPACT:
+                self._compact_file_cache()
+            elif records:
+                with open(self.temp_dir / "filecache.log", 'ab') as f:
+                    f.write(self._encode_cache_records(records))
+                self._cache_log_records += len(records)
         except Exception as e: # Catch specific exceptions if needed
             print(f"❌ 保存文件缓存失败: {e}")
 
@@ -277,42 +627,58 @@ class FileHandler:
         """添加文件到缓存"""
         if Path(file_path).exists():
             self.file_cache[file_hash] = str(file_path)
+            self._cache_checked_until[str(file_path)] = time.monotonic() + ClipboardConfig.FILE_CACHE_EXISTS_TTL
+            self._pending_cache_records.append((file_hash, str(file_path)))
+            self._schedule_cache_save()
+
+    def _schedule_cache_save(self):
+        """延迟保存文件缓存，合并短时间内的多次更新为一次写入"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError: # No event loop in this thread (e.g. worker threads): save right away
             self.save_file_cache()
+            return
+        if self._cache_save_handle is None:
+            self._cache_save_handle = loop.call_later(ClipboardConfig.FILE_CACHE_SAVE_DELAY, self.save_file_cache)
 
     def get_from_file_cache(self, file_hash):
         """从缓存获取文件路径"""
         path = self.file_cache.get(file_hash)
         if path:
-            path_obj = Path(path)
-            if path_obj.exists():
-                return str(path_obj)
+            now = time.monotonic()
+            if self._cache_checked_until.get(path, 0.0) > now: # Checked recently: skip the stat
+                return path
+            if os.path.exists(path):
+                self._cache_checked_until[path] = now + ClipboardConfig.FILE_CACHE_EXISTS_TTL
+                return path
             else:
                 # Remove stale entry from cache
                 print(f"🧹 清理无效缓存条目: {file_hash} -> {path}")
+                self._cache_checked_until.pop(path, None)
                 del self.file_cache[file_hash]
-                self.save_file_cache()
+                self._pending_cache_records.append((file_hash, None))
+                self._schedule_cache_save()
         return None
 
     def get_files_content_hash(self, file_paths):
-        """计算多个文件内容的MD5哈希值，跳过不存在的文件"""
-        # This is now an instance method, no need for @staticmethod
-        md5 = hashlib.md5()
+        """
+        计算多个文件内容的BLAKE3哈希值，跳过不存在的文件.
+        组合各文件的缓存哈希 (按路径、大小、mtime_ns 缓存): 未修改的文件不会重复读取，
+        随后发送文件信息时也直接复用同一结果.
+        """
+        hasher = blake3.blake3()
         valid_paths_found = False
         for path_str in file_paths:
             path = Path(path_str) # Ensure it's a Path object
             try:
-                if not path.is_file(): # Check if it's a file
+                st = os.stat(path) # One stat for the type check and the hash cache key
+                if not stat.S_ISREG(st.st_mode): # Check if it's a file
                     print(f"⚠️ 跳过非文件或不存在的路径: {path}")
                     continue
 
-                with open(path, 'rb') as f:
-                    valid_paths_found = True
-                    while True:
-                        # Read in larger chunks for potentially better performance
-                        chunk = f.read(1024 * 1024) # 1MB chunks
-                        if not chunk:
-                            break
-                        md5.update(chunk)
+                # Fixed-size digests need no separator between files
+                hasher.update(bytes.fromhex(ClipMessage.calculate_file_hash(path, st=st)))
+                valid_paths_found = True
             except FileNotFoundError:
                 print(f"⚠️ 文件不存在，跳过哈希: {path}")
                 continue
@@ -325,7 +691,7 @@ class FileHandler:
                 # or just skip the problematic file. Skipping for now.
                 continue
         # Only return a hash if at least one valid file was processed
-        return md5.hexdigest() if valid_paths_found else None
+        return hasher.hexdigest() if valid_paths_found else None
 
     async def handle_received_files(self, file_info_message, send_encrypted_func, sender_websocket=None):
         """
@@ -340,6 +706,7 @@ class FileHandler:
         files_to_request = []
         file_names = []
         cached_files = []
+        is_local_peer = self._is_loopback_peer(sender_websocket)
 
         for file_info in files:
             file_hash = file_info.get("hash")
@@ -357,6 +724,11 @@ class FileHandler:
             if cached_file_path:
                 print(f"✅ 文件 '{filename}' 在缓存中找到 (Hash: {file_hash[:8]}...)")
                 cached_files.append(cached_file_path)
+            elif is_local_peer and (local_copy := await asyncio.to_thread(self._copy_local_file, file_info)):
+                print(f"✅ 文件 '{filename}' 来自本机，已直接复制")
+                if file_hash:
+                    self.add_to_file_cache(file_hash, local_copy) # On the loop thread: cache state is not thread-safe
+                cached_files.append(local_copy)
             else:
                 if file_hash:
                     print(f"ℹ️ 文件 '{filename}' 不在缓存中或哈希缺失，请求传输。")
@@ -366,89 +738,102 @@ class FileHandler:
             print("✅ 所有收到的文件都在缓存中，无需请求。")
             # Set cached files to clipboard
             if cached_files:
-                if len(cached_files) == 1:
-                    # Single file - set directly to clipboard
-                    await self.set_clipboard_file(Path(cached_files[0]))
-                    print("📎 已将缓存文件设置到剪贴板")
-                else:
-                    # Multiple files - set all to clipboard
-                    from utils.clipboard_utils import ClipboardUtils
-                    if hasattr(ClipboardUtils, 'set_clipboard_files'):
-                        ClipboardUtils.set_clipboard_files([Path(f) for f in cached_files])
-                    else:
-                        # Fallback: set first file only
-                        await self.set_clipboard_file(Path(cached_files[0]))
-                    print(f"📎 已将 {len(cached_files)} 个缓存文件设置到剪贴板")
+                # All files go to the clipboard in a single write
+                await self.set_clipboard_file([Path(f) for f in cached_files])
+                print(f"📎 已将 {len(cached_files)} 个缓存文件设置到剪贴板")
             return True # Indicate success (all cached or no files)
 
         print(f"📥 收到文件信息: {', '.join(file_names[:3])}{' 等' if len(file_names) > 3 else ''}")
         print(f"📤 请求 {len(files_to_request)} 个文件内容...")
 
+        # Peers that advertise batch support get all requests in a single message
+        if len(files_to_request) > 1 and file_info_message.get("batch_requests"):
+            req_data = ClipMessage.serialize(ClipMessage.file_request_batch_message(files_to_request))
+            try:
+                await send_encrypted_func(req_data)
+            except Exception as e:
+                print(f"❌ 发送批量文件请求失败: {e}")
+            return True
+
         # Request each missing file
         for file_path in files_to_request:
             filename = Path(file_path).name # Extract filename for logging
             print(f"📤 请求文件: {filename}")
             file_req = ClipMessage.file_request_message(file_path) # Request using original path
-            req_json = ClipMessage.serialize(file_req)
+            req_data = ClipMessage.serialize(file_req)
 
             # Encrypt and send the request
             # If sender_websocket is provided, send directly, otherwise broadcast
             try:
-                await send_encrypted_func(req_json.encode('utf-8'))
+                await send_encrypted_func(req_data)
             except Exception as e:
                 print(f"❌ 发送文件请求失败 ({Path(file_path).name}): {e}")
                 # Consider how to handle partial request failures
 
-            await asyncio.sleep(ClipboardConfig.NETWORK_DELAY) # Small delay between requests
-
         return True # Indicate requests were sent
 
-    async def set_clipboard_file(self, file_path: Path):
-        """将文件路径设置到剪贴板 (Uses main thread for macOS)"""
+    @staticmethod
+    def _is_loopback_peer(websocket) -> bool:
+        """判断对端是否运行在本机 (回环地址)"""
         try:
-            path_str = str(file_path)
-            print(f"🔍 检查文件是否存在: {path_str} -> {file_path.exists()}")
-            if not file_path.exists():
-                print(f"❌ 文件不存在，无法设置到剪贴板: {path_str}")
+            return ipaddress.ip_address(websocket.remote_address[0]).is_loopback
+        except (AttributeError, TypeError, IndexError, ValueError):
+            return False
+
+    def _copy_local_file(self, file_info: dict) -> str | None:
+        """
+        对端在本机时直接复制源文件 (shutil.copyfile 使用 sendfile/copy_file_range/fcopyfile 在内核中复制),
+        跳过分块加密传输. 源文件大小或修改时间与文件信息不符时返回 None.
+        在线程中执行，只做复制; 缓存登记由调用方在事件循环中完成.
+        """
+        src = Path(file_info["path"])
+        try:
+            st = src.stat()
+            if st.st_size != file_info.get("size") or st.st_mtime != file_info.get("mtime"):
                 return None
-            
-            # Ensure file has proper permissions in original location
-            file_path.chmod(0o644)
-            print(f"🔓 设置文件权限: 644")
+            dest = self.temp_dir / file_info["filename"]
+            try:
+                shutil.copyfile(src, dest)
+            except shutil.SameFileError:
+                dest = src # Already in our temp dir
+        except OSError as e:
+            print(f"⚠️ 本机文件复制失败，改为请求传输: {e}")
+            return None
+
+        return str(dest)
+
+    async def set_clipboard_file(self, file_path: Path | list[Path]):
+        """将文件路径设置到剪贴板, 可传入多个文件一次写入 (Uses main thread for macOS)"""
+        try:
+            file_paths = list(file_path) if isinstance(file_path, (list, tuple)) else [file_path]
+            for path in file_paths:
+                if not path.exists():
+                    print(f"❌ 文件不存在，无法设置到剪贴板: {path}")
+                    return None
+                # Ensure file has proper permissions in original location
+                path.chmod(0o644)
+            path_strs = [str(path) for path in file_paths]
+            names = ", ".join(path.name for path in file_paths)
             if IS_MACOS:
                 # Try direct clipboard operation without the complex PasteboardSetter
-                print(f"🔄 正在设置文件到剪贴板: {Path(path_str).name}")
+                print(f"🔄 正在设置文件到剪贴板: {names}")
                 try:
-                    pasteboard = AppKit.NSPasteboard.generalPasteboard()
-                    pasteboard.clearContents()
-                    
-                    # Create file URL with multiple methods for better compatibility
-                    import Foundation
-                    
-                    # Method 1: Try with NSURL fileURLWithPath
-                    url = AppKit.NSURL.fileURLWithPath_(path_str)
-                    if not url:
-                        print(f"❌ 无法创建文件URL (方法1): {path_str}")
+                    pasteboard = self._pasteboard
+
+                    urls = [AppKit.NSURL.fileURLWithPath_(path_str) for path_str in path_strs]
+                    if not all(urls):
+                        print(f"❌ 无法创建文件URL: {names}")
                         return None
-                    
-                    # Method 2: Alternative - try creating URL differently  
-                    # url = Foundation.NSURL.URLWithString_("file://" + path_str.replace(" ", "%20"))
-                    
-                    print(f"🔗 创建文件URL: {url}")
-                    print(f"🔍 URL路径: {url.path()}")
-                    print(f"🔍 文件是否可读: {url.checkResourceIsReachableAndReturnError_(None)[0]}")
-                    
-                    # Method 1: Try writeObjects without declaring ownership first
+
+                    # Method 1: All URLs in one writeObjects call, without declaring ownership first
                     pasteboard.clearContents()
-                    urls = AppKit.NSArray.arrayWithObject_(url)
-                    success = pasteboard.writeObjects_(urls)
+                    success = pasteboard.writeObjects_(AppKit.NSArray.arrayWithArray_(urls))
                     print(f"📋 writeObjects (无所有权声明) 结果: {success}")
                     
                     if not success:
                         # Method 2: Use NSFilenamesPboardType with ownership
                         pasteboard.declareTypes_owner_([AppKit.NSFilenamesPboardType], None)
-                        filenames = [path_str]
-                        success = pasteboard.setPropertyList_forType_(filenames, AppKit.NSFilenamesPboardType)
+                        success = pasteboard.setPropertyList_forType_(path_strs, AppKit.NSFilenamesPboardType)
                         print(f"📋 setPropertyList (NSFilenamesPboardType) 结果: {success}")
                         
                         if success:
@@ -456,10 +841,10 @@ class FileHandler:
                             pasteboard.declareTypes_owner_([], None)
                             print(f"📋 已释放剪贴板所有权")
                     
-                    if not success:
-                        # Method 3: Try modern file URL type
+                    if not success and len(urls) == 1:
+                        # Method 3: Try modern file URL type (single file only)
                         pasteboard.declareTypes_owner_([AppKit.NSPasteboardTypeFileURL], None)
-                        success = pasteboard.setString_forType_(url.absoluteString(), AppKit.NSPasteboardTypeFileURL)
+                        success = pasteboard.setString_forType_(urls[0].absoluteString(), AppKit.NSPasteboardTypeFileURL)
                         print(f"📋 setString (NSPasteboardTypeFileURL) 结果: {success}")
                         
                         if success:
@@ -469,25 +854,11 @@ class FileHandler:
                     
                     if success:
                         change_count = pasteboard.changeCount()
-                        print(f"✅ 文件已直接添加到Mac剪贴板: {Path(path_str).name}")
+                        print(f"✅ 文件已直接添加到Mac剪贴板: {names}")
                         print(f"📋 剪贴板变化计数: {change_count}")
-                        
-                        # Debug: Check what types are actually on clipboard now
-                        types_after = pasteboard.types()
-                        print(f"🔍 设置后剪贴板类型: {list(types_after)}")
-                        
-                        # Debug: Check what content is on clipboard
-                        if AppKit.NSPasteboardTypeString in types_after:
-                            text_content = pasteboard.stringForType_(AppKit.NSPasteboardTypeString)
-                            print(f"🔍 剪贴板文本内容: {text_content[:50] if text_content else 'None'}...")
-                        
-                        if AppKit.NSFilenamesPboardType in types_after:
-                            file_list = pasteboard.propertyListForType_(AppKit.NSFilenamesPboardType)
-                            print(f"🔍 剪贴板文件列表: {file_list}")
-                        
                         return change_count
                     else:
-                        print(f"❌ 直接添加文件到Mac剪贴板失败: {Path(path_str).name}")
+                        print(f"❌ 直接添加文件到Mac剪贴板失败: {names}")
                         return None
                         
                 except Exception as e:
@@ -500,12 +871,13 @@ class FileHandler:
                 # Use the Windows clipboard utility directly
                 from utils.clipboard_utils import ClipboardUtils
                 try:
-                    success = ClipboardUtils.set_clipboard_file(file_path)
+                    # Blocking Win32 clipboard call: run it on the shared default executor
+                    success = await asyncio.to_thread(ClipboardUtils.set_clipboard_file, file_paths)
                     if success:
-                        print(f"📎 已将文件添加到剪贴板: {file_path.name}")
+                        print(f"📎 已将文件添加到剪贴板: {names}")
                         return True
                     else:
-                        print(f"❌ 设置Windows剪贴板文件失败: {file_path.name}")
+                        print(f"❌ 设置Windows剪贴板文件失败: {names}")
                         return False
                 except Exception as e:
                     print(f"❌ Windows剪贴板设置出错: {e}")
@@ -522,9 +894,12 @@ class FileHandler:
 
     async def handle_clipboard_files(self, file_urls, last_content_hash, send_encrypted_fn):
         """处理剪贴板中的文件, 发送文件信息"""
-        # Calculate hash based on the list of file paths
-        file_paths_str = str(sorted(file_urls)) # Sort for consistent hashing
-        content_hash = hashlib.md5(file_paths_str.encode()).hexdigest()
+        # Calculate hash based on the list of file paths (sorted, NUL-separated: NUL cannot appear in a path)
+        hasher = blake3.blake3()
+        for path in sorted(file_urls):
+            hasher.update(str(path).encode('utf-8'))
+            hasher.update(b'\x00')
+        content_hash = hasher.hexdigest(length=16)
 
         # Check for duplicates based on the list of paths
         if content_hash == last_content_hash:
@@ -535,22 +910,39 @@ class FileHandler:
         file_names = [os.path.basename(p) for p in file_urls]
         print(f"📤 发送文件信息: {', '.join(file_names[:3])}{' 等' if len(file_names) > 3 else ''}")
 
-        # Create file message (includes hashes now)
-        file_msg = ClipMessage.file_message(file_urls)
-        message_json = ClipMessage.serialize(file_msg)
+        # Hash all files concurrently in worker threads (open/mmap latency of many small files overlaps);
+        # files that failed are retried inside file_message, which reports missing files as before
+        hashes = await asyncio.gather(
+            *(asyncio.to_thread(ClipMessage.calculate_file_hash, path) for path in file_urls),
+            return_exceptions=True
+        )
+        file_hashes = {path: file_hash for path, file_hash in zip(file_urls, hashes) if isinstance(file_hash, str)}
+
+        # Create file message (includes hashes; runs in a thread to keep the loop responsive)
+        file_msg = await asyncio.to_thread(ClipMessage.file_message, file_urls, file_hashes)
+        message_data = ClipMessage.serialize(file_msg)
 
         # Encrypt and broadcast file info
-        await send_encrypted_fn(message_json.encode('utf-8'))
+        await send_encrypted_fn(message_data)
         print("🔐 已发送加密的文件信息")
 
         # Return the new hash and indicate that a change was sent
         return content_hash, True
 
 
+    def text_hash(self, text: str) -> str:
+        """计算文本的MD5哈希; 与上次相同的文本直接复用结果 (字符串比较远比编码+哈希便宜)"""
+        if text != self._last_hashed_text:
+            text_hash = hashlib.md5(text.encode()).hexdigest()
+            self._last_hashed_text, self._last_text_hash = text, text_hash
+        return self._last_text_hash
+
     async def process_clipboard_content(self, text: str, current_time: float, last_content_hash: str,
-                                     last_update_time: float, send_encrypted_fn) -> tuple[str, float, bool]:
+                                     last_update_time: float, send_encrypted_fn,
+                                     content_hash: str | None = None) -> tuple[str, float, bool]:
         """
         处理剪贴板文本内容, 发送文本消息.
+        content_hash: 调用方已计算的文本MD5 (可选，避免重复哈希)
         Returns: (new_hash, new_update_time, sent_update)
         """
         # If content is empty or looks like temp path, do nothing
@@ -558,7 +950,8 @@ class FileHandler:
             return last_content_hash, last_update_time, False
 
         # Calculate content hash
-        content_hash = hashlib.md5(text.encode()).hexdigest()
+        if content_hash is None:
+            content_hash = self.text_hash(text)
 
         # If same as last content, skip
         if content_hash == last_content_hash:
@@ -576,10 +969,10 @@ class FileHandler:
 
         # Create text message
         text_msg = ClipMessage.text_message(text)
-        message_json = ClipMessage.serialize(text_msg)
+        message_data = ClipMessage.serialize(text_msg)
 
         # Encrypt and broadcast
-        await send_encrypted_fn(message_json.encode('utf-8'))
+        await send_encrypted_fn(message_data)
         print("🔐 已发送加密的文本")
 
         # Return new state
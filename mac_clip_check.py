@@ -2,6 +2,7 @@ import AppKit
 import asyncio
 import websockets
 import json
+import logging
 import signal
 import time
 from utils.security.crypto import SecurityManager
@@ -10,12 +11,13 @@ from utils.network.discovery import DeviceDiscovery
 from utils.message_format import ClipMessage, MessageType
 import tempfile
 from pathlib import Path
-import hashlib
 from handlers.file_handler import FileHandler
 from config import ClipboardConfig # Import config
 from utils.security.pairing import PairingManager, PairingStatus
 import threading
 
+log = logging.getLogger(__name__)
+
 class ClipboardListener:
     """剪贴板监听和同步服务器"""
 
@@ -146,7 +148,8 @@ class ClipboardListener:
                         await websocket.send(json.dumps({
                             'status': 'pairing_accepted',
                             'server_id': 'mac-server',
-                            'token': token
+                            'token': token,
+                            'binary_chunks': True # Unsolicited file pushes may use binary chunk frames
                         }))
                         print(f"✅ 设备 {device_id} 配对成功并已授权")
                     elif pairing_result == PairingStatus.REJECTED:
@@ -176,7 +179,8 @@ class ClipboardListener:
                         return # Close connection
                     await websocket.send(json.dumps({
                         'status': 'authorized',
-                        'server_id': 'mac-server'
+                        'server_id': 'mac-server',
+                        'binary_chunks': True # Unsolicited file pushes may use binary chunk frames
                     }))
                     print(f"✅ 设备 {device_id} 验证成功")
 
@@ -204,12 +208,13 @@ class ClipboardListener:
             self.connected_clients.add(websocket)
             print(f"✅ 设备 {device_id} 已连接并完成密钥交换")
 
+            recv_buffer = bytearray(ClipboardConfig.RECV_BUFFER_SIZE) # Reused for every decrypted message from this client
             while self.running: # Rely on exceptions inside the loop to detect closure
                 try:
                     # Use longer timeout or rely on keepalive if implemented
                     encrypted_data = await asyncio.wait_for(websocket.recv(), timeout=30.0)
                     # Pass the specific client's websocket for potential direct replies
-                    await self.process_received_data(encrypted_data, sender_websocket=websocket)
+                    await self.process_received_data(encrypted_data, sender_websocket=websocket, recv_buffer=recv_buffer)
                 except asyncio.TimeoutError:
                     # Send keepalive ping or check connection status
                     try:
@@ -249,11 +254,10 @@ class ClipboardListener:
             print(f"➖ 设备 {device_id or client_ip} 已断开")
 
 
-    async def _send_encrypted(self, data: bytes, websocket):
-        """Helper to encrypt and send data to a specific websocket."""
+    async def _send_encrypted(self, data: bytes, websocket, encrypted: bool = False):
+        """Helper to encrypt and send data to a specific websocket (encrypted=True: data is already encrypted)."""
         try:
-            encrypted = self.security_mgr.encrypt_message(data)
-            await websocket.send(encrypted)
+            await websocket.send(data if encrypted else await self.security_mgr.encrypt_message_async(data))
         except Exception as e:
             print(f"❌ 发送加密数据失败: {e}")
             # Handle potential connection closure
@@ -261,24 +265,31 @@ class ClipboardListener:
                 self.connected_clients.remove(websocket)
 
 
-    async def process_received_data(self, encrypted_data, sender_websocket=None):
-        """处理从客户端接收到的加密数据"""
+    async def process_received_data(self, encrypted_data, sender_websocket=None, recv_buffer: bytearray | None = None):
+        """处理从客户端接收到的加密数据 (recv_buffer: 该连接复用的解密缓冲区)"""
         if not sender_websocket: # Should always have a sender
              print("⚠️ process_received_data called without sender_websocket")
              return
 
         try:
             self.is_receiving = True # Set flag to pause local clipboard monitoring
-            decrypted_data = self.security_mgr.decrypt_message(encrypted_data)
-            message_json = decrypted_data.decode('utf-8')
-            message = ClipMessage.deserialize(message_json)
+            if recv_buffer is not None:
+                decrypted_data = self.security_mgr.decrypt_message_into(encrypted_data, recv_buffer)
+            else:
+                decrypted_data = self.security_mgr.decrypt_message(encrypted_data)
+            if ClipMessage.is_file_chunk(decrypted_data):
+                message = ClipMessage.parse_file_chunk(decrypted_data) # Binary file chunk frame
+            elif ClipMessage.is_file_bundle(decrypted_data):
+                message = ClipMessage.parse_file_bundle(decrypted_data) # Several small files in one frame
+            else:
+                message = ClipMessage.deserialize(decrypted_data)
 
             if not message or "type" not in message:
                  print("⚠️ 收到的消息格式无效或无法解析")
                  return
 
             msg_type = message["type"]
-            print(f"📬 收到消息类型: {msg_type}") # Log received type
+            log.debug("📬 收到消息类型: %s", msg_type) # Per message (every file chunk): debug only
 
             if msg_type == MessageType.TEXT:
                 text = message.get("content", "")
@@ -291,7 +302,7 @@ class ClipboardListener:
                     return
 
                 # Calculate hash *before* setting clipboard
-                content_hash = hashlib.md5(text.encode()).hexdigest()
+                content_hash = self.file_handler.text_hash(text)
 
                 # Check if this content hash was the last one *we* sent or set
                 if content_hash == self.last_content_hash:
@@ -329,69 +340,40 @@ class ClipboardListener:
                     sender_websocket=sender_websocket # Pass sender for context if needed by handler
                 )
 
-            elif msg_type == MessageType.FILE_RESPONSE:
+            elif msg_type in (MessageType.FILE_CHUNK, MessageType.FILE_RESPONSE):
                 # Handle incoming file chunk
-                is_complete, completed_path = self.file_handler.handle_received_chunk(message)
-                if is_complete and completed_path:
-                    print(f"✅ 文件接收完成: {completed_path}")
+                await self._handle_file_chunk(message)
 
-                    # Calculate hash of the completed file
-                    content_hash = self.file_handler.get_files_content_hash([str(completed_path)])
+            elif msg_type == MessageType.FILE_BUNDLE:
+                # Several small files, each a complete single-chunk transfer
+                for chunk in message["chunks"]:
+                    await self._handle_file_chunk(chunk)
 
-                    # Check if this file content hash was the last one *we* sent or set
-                    if content_hash and content_hash == self.last_content_hash:
-                         print("⏭️ 跳过重复文件内容 (与本地最后发送/设置一致)")
-                         return
-
-                    # Store info but delay clipboard setting until after all logging
-                    file_to_set = completed_path
-                    content_hash_to_use = content_hash
-                    
-                    # Set file to clipboard AFTER all processing/logging
-                    await asyncio.sleep(0.1)  # Let any pending logs flush
-                    change_count = self.file_handler.set_clipboard_file(file_to_set)
-                    if change_count is not None:
-                        # Update change count to track the clipboard state
-                        self.last_change_count = change_count
-                        
-                        # Mark this specific content as processed to prevent re-broadcast
-                        self.last_content_hash = content_hash_to_use  # Mark as processed
-                        self.last_update_time = time.time()
-                        
-                        # Completely stop clipboard monitoring temporarily
-                        self.ignore_clipboard_until = time.time() + 10.0  # 10 second ignore period
-                        
-                        # Record remote hash for loop detection
-                        self.last_remote_content_hash = content_hash_to_use
-                        self.last_remote_update_time = time.time()
-                        
-                        print("✅ 文件已设置到剪贴板并可用于粘贴")
-                        print("🔄 文件已标记为已处理，防止重复广播")
-                        print("⏳ 暂停监控10秒以确保文件可访问")
-                        print("💡 在接下来10秒内，您可以自由粘贴文件而不受监控干扰")
-
-                        # No delay needed since monitoring is paused
-                        # await asyncio.sleep(0.05)
-
-                    else:
-                         print(f"❌ 将文件 {completed_path.name} 设置到剪贴板失败")
-
-            elif msg_type == MessageType.FILE_REQUEST:
-                 # Handle request from a client to send a file
-                 file_path_requested = message.get("path")
-                 if file_path_requested:
+            elif msg_type in (MessageType.FILE_REQUEST, MessageType.FILE_REQUEST_BATCH):
+                 # Handle request from a client to send one file (or a batch of files)
+                 if msg_type == MessageType.FILE_REQUEST:
+                      paths_requested = [message.get("path")]
+                 else:
+                      paths_requested = message.get("paths") or []
+                 normalized_paths = []
+                 for file_path_requested in paths_requested:
+                      if not file_path_requested:
+                           print("⚠️ 收到的文件请求缺少路径")
+                           continue
                       # Normalize path separators for cross-platform compatibility
                       normalized_path = file_path_requested.replace('\\', '/')
                       print(f"📤 收到文件请求: {Path(normalized_path).name}")
                       print(f"🔍 原始路径: {file_path_requested}")
                       print(f"🔍 标准化路径: {normalized_path}")
-                      # Pass a function to encrypt and send data back to the *requester*
-                      await self.file_handler.handle_file_transfer(
-                           normalized_path,
-                           lambda data: self._send_encrypted(data, sender_websocket) # Send file chunks back to sender
-                      )
-                 else:
-                      print("⚠️ 收到的文件请求缺少路径")
+                      normalized_paths.append(normalized_path)
+                 # Pass a function to encrypt and send data back to the *requester* (batch requesters understand bundles)
+                 await self.file_handler.handle_files_transfer(
+                      normalized_paths,
+                      lambda data, encrypted=False: self._send_encrypted(data, sender_websocket, encrypted), # Send file chunks back to sender
+                      bundle=msg_type == MessageType.FILE_REQUEST_BATCH,
+                      # Older peers request without binary_chunks and only understand JSON chunks
+                      binary_chunks=msg_type == MessageType.FILE_REQUEST_BATCH or bool(message.get("binary_chunks"))
+                 )
 
             else:
                  print(f"⚠️ 未知消息类型: {msg_type}")
@@ -409,13 +391,59 @@ class ClipboardListener:
             self.is_receiving = False # Release lock
 
 
+    async def _handle_file_chunk(self, message):
+        """处理接收到的文件块，文件接收完成后设置到剪贴板"""
+        is_complete, completed_path = await self.file_handler.handle_received_chunk(message)
+        if is_complete and completed_path:
+            print(f"✅ 文件接收完成: {completed_path}")
+
+            # Calculate hash of the completed file
+            content_hash = await asyncio.to_thread(self.file_handler.get_files_content_hash, [str(completed_path)])
+
+            # Check if this file content hash was the last one *we* sent or set
+            if content_hash and content_hash == self.last_content_hash:
+                 print("⏭️ 跳过重复文件内容 (与本地最后发送/设置一致)")
+                 return
+
+            # Store info but delay clipboard setting until after all logging
+            file_to_set = completed_path
+            content_hash_to_use = content_hash
+
+            # Set file to clipboard AFTER all processing/logging
+            change_count = await self.file_handler.set_clipboard_file(file_to_set)
+            if change_count is not None:
+                # Update change count to track the clipboard state
+                self.last_change_count = change_count
+
+                # Mark this specific content as processed to prevent re-broadcast
+                self.last_content_hash = content_hash_to_use  # Mark as processed
+                self.last_update_time = time.time()
+
+                # Completely stop clipboard monitoring temporarily
+                self.ignore_clipboard_until = time.time() + 10.0  # 10 second ignore period
+
+                # Record remote hash for loop detection
+                self.last_remote_content_hash = content_hash_to_use
+                self.last_remote_update_time = time.time()
+
+                print("✅ 文件已设置到剪贴板并可用于粘贴")
+                print("🔄 文件已标记为已处理，防止重复广播")
+                print("⏳ 暂停监控10秒以确保文件可访问")
+                print("💡 在接下来10秒内，您可以自由粘贴文件而不受监控干扰")
+
+                # No delay needed since monitoring is paused
+                # await asyncio.sleep(0.05)
+
+            else:
+                 print(f"❌ 将文件 {completed_path.name} 设置到剪贴板失败")
+
     async def broadcast_encrypted_data(self, data_to_encrypt: bytes, exclude_client=None):
         """Encrypts and broadcasts data to all connected clients, excluding one if specified."""
         if not self.connected_clients:
             return
 
         try:
-            encrypted_data = self.security_mgr.encrypt_message(data_to_encrypt)
+            encrypted_data = await self.security_mgr.encrypt_message_async(data_to_encrypt) # Large payloads encrypt in a worker thread
         except Exception as e:
              print(f"❌ 加密广播数据失败: {e}")
              return
@@ -471,6 +499,9 @@ class ClipboardListener:
                     ClipboardConfig.HOST, # Use config
                     port,
                     subprotocols=["binary"],
+                    max_size=ClipboardConfig.MAX_MESSAGE_SIZE, # Allow large file chunks
+                    compression=None, # Payloads are AES-GCM ciphertext: deflate only burns CPU and copies
+                    write_limit=ClipboardConfig.WRITE_BUFFER_LIMIT, # Keep the socket busy across chunk boundaries
                     ping_interval=20, # Send pings every 20s
                     ping_timeout=20   # Wait 20s for pong response
                 )
@@ -531,13 +562,13 @@ class ClipboardListener:
 
                 # Ignore if we recently updated the clipboard locally
                 if current_time < self.ignore_clipboard_until:
-                    await asyncio.sleep(0.1) # Short sleep during ignore window
+                    await asyncio.sleep(self.ignore_clipboard_until - current_time) # Sleep until the ignore window ends
                     continue
 
                 # Check if enough time has passed since the last processing
                 time_since_process = current_time - last_processed_time
                 if time_since_process < ClipboardConfig.MIN_PROCESS_INTERVAL:
-                    await asyncio.sleep(0.1) # Wait if processing too frequently
+                    await asyncio.sleep(ClipboardConfig.MIN_PROCESS_INTERVAL - time_since_process) # Wait out the remaining interval
                     continue
 
                 # Check for actual clipboard change count
@@ -611,7 +642,7 @@ class ClipboardListener:
                 text = self.pasteboard.stringForType_(AppKit.NSPasteboardTypeString)
                 if text and self.connected_clients: # Ensure text is not empty and we have connected clients
                     # Anti-loop check: Compare with last received remote hash
-                    content_hash = hashlib.md5(text.encode()).hexdigest()
+                    content_hash = self.file_handler.text_hash(text)
                     if (self.last_remote_content_hash == content_hash and
                         time.time() - self.last_remote_update_time < ClipboardConfig.UPDATE_DELAY * 2): # Wider window for remote check
                         # print("⏭️ 跳过发送回环内容 (与远程接收一致)") # Less verbose
@@ -624,7 +655,8 @@ class ClipboardListener:
                         current_time,
                         self.last_content_hash,
                         self.last_update_time,
-                        self.broadcast_encrypted_data # Pass broadcast function
+                        self.broadcast_encrypted_data, # Pass broadcast function
+                        content_hash=content_hash # Already computed for the anti-loop check
                     )
                     if update_sent:
                         self.last_content_hash = new_hash
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Test script for binary file chunk frames and FileHandler round-trips
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from config import ClipboardConfig
+from handlers.file_handler import FileHandler
+from utils.message_format import ClipMessage, MessageType
+from utils.security.crypto import SecurityManager
+
+
+def test_file_chunk_frame_roundtrip():
+    """Test packing and parsing a binary file chunk frame"""
+    print("🧪 Testing file chunk frame round-trip...")
+
+    data = os.urandom(1024)
+    file_hash = "ab" * 32
+    frame = ClipMessage.file_chunk_frame("测试.bin", 2, 5, 5000, 2048, data, file_hash)
+
+    assert ClipMessage.is_file_chunk(frame)
+    assert not ClipMessage.is_file_chunk(b'{"type": "text"}')
+
+    message = ClipMessage.parse_file_chunk(frame)
+    assert message["type"] == MessageType.FILE_CHUNK
+    assert message["filename"] == "测试.bin"
+    assert message["chunk_index"] == 2
+    assert message["total_chunks"] == 5
+    assert message["file_size"] == 5000
+    assert message["offset"] == 2048
+    assert bytes(message["chunk_data"]) == data
+    assert message["file_hash"] == file_hash
+
+    message = ClipMessage.parse_file_chunk(ClipMessage.file_chunk_frame("a", 0, 1, 0, 0, b""))
+    assert message["file_hash"] is None
+    assert bytes(message["chunk_data"]) == b""
+
+    try:
+        ClipMessage.parse_file_chunk(frame[:-1])
+        assert False, "Truncated frame should be rejected"
+    except ValueError:
+        pass
+
+    print("✅ File chunk frame test passed!")
+
+
+async def _transfer(size: int, chunk_size: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        src = tmp / "source.bin"
+        src.write_bytes(os.urandom(size))
+
+        sender = FileHandler(tmp / "send", None)
+        receiver = FileHandler(tmp / "recv", None)
+        sender.chunk_size = chunk_size
+
+        frames = []
+        async def send(data: bytes):
+            frames.append(data)
+
+        assert await sender.handle_file_transfer(str(src), send)
+
+        result = (False, None)
+        for frame in frames:
+            assert ClipMessage.is_file_chunk(frame)
+            result = await receiver.handle_received_chunk(ClipMessage.parse_file_chunk(frame))
+
+        is_complete, path = result
+        assert is_complete, f"Transfer of {size} bytes did not complete"
+        assert path.read_bytes() == src.read_bytes()
+        return len(frames)
+
+
+def test_file_transfer_roundtrip():
+    """Test sending files through FileHandler and reassembling them"""
+    print("🧪 Testing file transfer round-trip...")
+
+    for size, chunk_size in ((0, 1024), (10, 1024), (4096, 1024), (5000, 1024)):
+        count = asyncio.run(_transfer(size, chunk_size))
+        print(f"  {size} bytes -> {count} frames")
+
+    print("✅ File transfer round-trip test passed!")
+
+
+async def _encrypted_transfer(size: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        src = tmp / "source.bin"
+        src.write_bytes(os.urandom(size))
+
+        sender_security = SecurityManager()
+        sender_security.set_shared_key_from_password("clipshare-test")
+        receiver_security = SecurityManager()
+        receiver_security.set_shared_key_from_password("clipshare-test")
+
+        sender = FileHandler(tmp / "send", sender_security)
+        receiver = FileHandler(tmp / "recv", receiver_security)
+        recv_buffer = bytearray(ClipboardConfig.RECV_BUFFER_SIZE)
+
+        frames = 0
+        send_buffers = set()
+        result = (False, None)
+        async def send(data, encrypted=False):
+            nonlocal frames, result
+            assert encrypted, "File frames must be encrypted before sending"
+            if isinstance(data, memoryview):
+                send_buffers.add(id(data.obj))
+            frames += 1
+            # websockets delivers each message as bytes, decrypted into the connection's reused buffer
+            frame = receiver_security.decrypt_message_into(bytes(data), recv_buffer)
+            assert ClipMessage.is_file_chunk(frame)
+            result = await receiver.handle_received_chunk(ClipMessage.parse_file_chunk(frame))
+
+        assert await sender.handle_file_transfer(str(src), send)
+
+        is_complete, path = result
+        assert is_complete, f"Encrypted transfer of {size} bytes did not complete"
+        assert path.read_bytes() == src.read_bytes()
+        assert len(send_buffers) <= ClipboardConfig.MAX_CONCURRENT_CHUNKS + 2, "Send buffers should be reused"
+        return frames
+
+
+def test_encrypted_transfer_roundtrip():
+    """Test encrypted chunk frames with a real shared key, including buffer reuse on both ends"""
+    print("🧪 Testing encrypted file transfer round-trip...")
+
+    for size in (0, 2 * ClipboardConfig.CHUNK_SIZE + 12345):
+        count = asyncio.run(_encrypted_transfer(size))
+        print(f"  {size} bytes -> {count} frames")
+
+    print("✅ Encrypted file transfer round-trip test passed!")
+
+
+def test_file_bundle_roundtrip():
+    """Test bundling small files into one frame while large files stay chunked"""
+    print("🧪 Testing small file bundles...")
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            sources = []
+            for name, size in (("a.txt", 10), ("empty.bin", 0), ("big.bin", 1536 * 1024), ("c.bin", 3000)):
+                src = tmp / name
+                src.write_bytes(os.urandom(size))
+                sources.append(src)
+
+            sender = FileHandler(tmp / "send", None)
+            receiver = FileHandler(tmp / "recv", None)
+            sender.chunk_size = 1024 * 1024
+
+            frames = []
+            async def send(data: bytes):
+                frames.append(data)
+
+            await sender.handle_files_transfer([str(src) for src in sources], send, bundle=True)
+            # a+empty bundled, big in 2 chunks, c alone (sent as a plain frame)
+            assert [ClipMessage.is_file_bundle(frame) for frame in frames] == [True, False, False, False]
+
+            completed = []
+            for frame in frames:
+                if ClipMessage.is_file_bundle(frame):
+                    chunks = ClipMessage.parse_file_bundle(frame)["chunks"]
+                else:
+                    chunks = [ClipMessage.parse_file_chunk(frame)]
+                for chunk in chunks:
+                    is_complete, path = await receiver.handle_received_chunk(chunk)
+                    if is_complete:
+                        completed.append(path)
+
+            assert [path.name for path in completed] == [src.name for src in sources]
+            for src, path in zip(sources, completed):
+                assert path.read_bytes() == src.read_bytes()
+
+    asyncio.run(run())
+    print("✅ Small file bundle test passed!")
+
+
+def test_legacy_chunk_receive():
+    """Test reassembling legacy JSON+base64 chunks without size/offset fields"""
+    print("🧪 Testing legacy chunk receive...")
+
+    data = os.urandom(10)
+    with tempfile.TemporaryDirectory() as tmp:
+        file_hash = hashlib.md5(data).hexdigest() # Older peers send MD5 file hashes
+
+        receiver = FileHandler(Path(tmp) / "recv", None)
+        for index, start in enumerate(range(0, len(data), 4)):
+            result = asyncio.run(receiver.handle_received_chunk({
+                "type": MessageType.FILE_RESPONSE,
+                "filename": "legacy.bin",
+                "chunk_index": index,
+                "total_chunks": 3,
+                "chunk_data": base64.b64encode(data[start:start + 4]).decode('utf-8'),
+                "file_hash": file_hash if index == 0 else None
+            }))
+
+        is_complete, path = result
+        assert is_complete
+        assert path.read_bytes() == data
+
+    print("✅ Legacy chunk receive test passed!")
+
+
+def test_legacy_chunk_send():
+    """Test sending JSON+base64 chunks to peers that do not request binary frames"""
+    print("🧪 Testing legacy chunk send...")
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            src = tmp / "legacy.bin"
+            src.write_bytes(os.urandom(ClipboardConfig.LEGACY_CHUNK_SIZE * 2 + 10))
+
+            sender = FileHandler(tmp / "send", None)
+            receiver = FileHandler(tmp / "recv", None)
+
+            frames = []
+            async def send(data: bytes):
+                frames.append(data)
+
+            assert await sender.handle_file_transfer(str(src), send, binary_chunks=False)
+            assert len(frames) == 3
+
+            result = (False, None)
+            for frame in frames:
+                assert not ClipMessage.is_file_chunk(frame)
+                message = json.loads(frame.decode('utf-8')) # What older peers do with every message
+                assert message["type"] == MessageType.FILE_RESPONSE
+                if message["chunk_index"] == 0:
+                    assert message["file_hash"] == hashlib.md5(src.read_bytes()).hexdigest()
+                result = await receiver.handle_received_chunk(message)
+
+            is_complete, path = result
+            assert is_complete
+            assert path.read_bytes() == src.read_bytes()
+
+    asyncio.run(run())
+    print("✅ Legacy chunk send test passed!")
+
+
+def test_file_cache_log():
+    """Test file cache log replay, torn-line recovery, compaction and legacy JSON migration"""
+    print("🧪 Testing file cache log...")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = []
+        for index in range(3):
+            path = tmp / f"cached{index}.bin"
+            path.write_bytes(os.urandom(16))
+            files.append(str(path))
+
+        # Replay: later records win, null records delete (no event loop, so every add saves right away)
+        handler = FileHandler(tmp, None)
+        handler.add_to_file_cache("a" * 64, files[0])
+        handler.add_to_file_cache("b" * 64, files[1])
+        handler.add_to_file_cache("a" * 64, files[2])
+        Path(files[1]).unlink()
+        assert FileHandler(tmp, None).file_cache == {"a" * 64: files[2]} # Missing files are pruned on load
+
+        # Torn last line after a crash: earlier records survive and the log is rewritten without it
+        log_path = tmp / "filecache.log"
+        with open(log_path, "ab") as f:
+            f.write(b'["c' )
+        handler = FileHandler(tmp, None)
+        assert handler.file_cache == {"a" * 64: files[2]}
+        assert log_path.read_bytes().endswith(b"\n")
+        assert len(log_path.read_bytes().splitlines()) == 1
+
+        # Compaction: superseded records are rewritten once they outnumber the live ones
+        for _ in range(200):
+            handler.add_to_file_cache("a" * 64, files[0])
+        assert len(log_path.read_bytes().splitlines()) < 200
+        assert FileHandler(tmp, None).file_cache == {"a" * 64: files[0]}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        kept = tmp / "kept.bin"
+        kept.write_bytes(b"data")
+        (tmp / "filecache.json").write_text(json.dumps({"d" * 64: str(kept), "e" * 64: str(tmp / "gone.bin")}))
+
+        # Legacy filecache.json is migrated to the log once (missing files pruned)
+        handler = FileHandler(tmp, None)
+        assert handler.file_cache == {"d" * 64: str(kept)}
+        assert not (tmp / "filecache.json").exists()
+        assert FileHandler(tmp, None).file_cache == {"d" * 64: str(kept)}
+
+    print("✅ File cache log test passed!")
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Starting file transfer tests...\n")
+
+    test_file_chunk_frame_roundtrip()
+    print()
+
+    test_file_transfer_roundtrip()
+    print()
+
+    test_encrypted_transfer_roundtrip()
+    print()
+
+    test_file_bundle_roundtrip()
+    print()
+
+    test_legacy_chunk_receive()
+    print()
+
+    test_legacy_chunk_send()
+    print()
+
+    test_file_cache_log()
+    print()
+
+    print("🎉 All file transfer tests completed successfully!")
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,10 @@ from utils.platform_config import IS_WINDOWS, IS_MACOS
 from config import ClipboardConfig
 
 if IS_WINDOWS:
+    import pywintypes
     import win32clipboard
     import win32con
+    import winerror
     from ctypes import Structure, c_uint, sizeof
     import pyperclip
 elif IS_MACOS:
@@ -59,13 +61,27 @@ class ClipboardUtils:
                     print(f"❌ 读取剪贴板文件失败: {e}")
             return None
 
+        @staticmethod
+        def _open_clipboard():
+            """打开剪贴板，被其他应用占用 (ERROR_ACCESS_DENIED) 时短暂重试"""
+            for attempt in range(ClipboardConfig.CLIPBOARD_OPEN_RETRIES):
+                try:
+                    win32clipboard.OpenClipboard()
+                    return
+                except pywintypes.error as e:
+                    if e.winerror != winerror.ERROR_ACCESS_DENIED or attempt == ClipboardConfig.CLIPBOARD_OPEN_RETRIES - 1:
+                        raise
+                    time.sleep(ClipboardConfig.CLIPBOARD_RETRY_DELAY)
+
         @staticmethod 
-        def set_clipboard_file(file_path: Path) -> bool:
-            """设置Windows剪贴板文件"""
+        def set_clipboard_file(file_path: Path | list[Path]) -> bool:
+            """设置Windows剪贴板文件 (多个文件放入同一个 CF_HDROP，只打开一次剪贴板)"""
             from windows_client import DROPFILES, HAS_WIN32COM
+            file_paths = list(file_path) if isinstance(file_path, (list, tuple)) else [file_path]
+            names = ", ".join(path.name for path in file_paths)
             try:
-                path_str = str(file_path.resolve())
-                files = path_str + '\0'
+                # DROPFILES is followed by NUL-separated paths and a final extra NUL
+                files = "".join(str(path.resolve()) + '\0' for path in file_paths)
                 file_bytes = files.encode('utf-16le') + b'\0\0'
 
                 df = DROPFILES()
@@ -76,11 +92,11 @@ class ClipboardUtils:
 
                 data = bytes(df) + file_bytes
 
-                win32clipboard.OpenClipboard()
+                ClipboardUtils._open_clipboard()
                 try:
                     win32clipboard.EmptyClipboard()
                     win32clipboard.SetClipboardData(win32con.CF_HDROP, data)
-                    print(f"📎 已将文件添加到剪贴板: {file_path.name}")
+                    print(f"📎 已将文件添加到剪贴板: {names}")
                     return True
                 finally:
                     win32clipboard.CloseClipboard()
@@ -89,8 +105,8 @@ class ClipboardUtils:
                 print(f"❌ 使用 CF_HDROP 设置剪贴板文件失败: {e}")
                 # Fallback to text
                 try:
-                    pyperclip.copy(str(file_path))
-                    print(f"📎 已将文件路径作为文本复制到剪贴板: {file_path.name}")
+                    pyperclip.copy("\n".join(str(path) for path in file_paths))
+                    print(f"📎 已将文件路径作为文本复制到剪贴板: {names}")
                     return True
                 except Exception:
                     return False
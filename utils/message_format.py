@@ -1,8 +1,39 @@
-import json
 import base64
+import functools
+import hashlib
+import json
+import mmap
 import os
+import struct
 from pathlib import Path
-import hashlib
+import blake3
+
+try:
+    import pybase64 # SIMD-accelerated base64
+    HAS_PYBASE64 = True
+except ImportError:
+    HAS_PYBASE64 = False
+
+# pybase64 的 SIMD 路径有固定调用开销: 小于此长度的编码输入用标准库更快 (解码在所有长度上都不慢于标准库)
+PYBASE64_MIN_ENCODE_SIZE = 128
+
+def b64encode_str(data):
+    """Base64 编码为 str，按输入大小选择实现"""
+    if HAS_PYBASE64 and len(data) >= PYBASE64_MIN_ENCODE_SIZE:
+        return pybase64.b64encode_as_string(data) # Encodes straight to str, no separate decode copy
+    return base64.b64encode(data).decode('utf-8')
+
+def b64decode(data):
+    """Base64 解码 (有 pybase64 时使用 SIMD 实现)"""
+    if HAS_PYBASE64:
+        return pybase64.b64decode(data)
+    return base64.b64decode(data)
+
+try:
+    import orjson # Faster (de)serialization, works on bytes without a separate encode/decode
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 class MessageType:
     TEXT = "text"
@@ -11,6 +42,26 @@ class MessageType:
     FILE_CHUNK = "file_chunk"
     FILE_RESPONSE = "file_response"
     FILE_REQUEST = "file_request"  
+    FILE_REQUEST_BATCH = "file_request_batch"
+    FILE_BUNDLE = "file_bundle"
+
+# 二进制文件块帧: 固定头 + UTF-8 文件名 + 原始块数据 (不经过 base64/JSON)
+# magic, chunk_index, total_chunks, file_size, offset, chunk_len, filename_len, file_hash
+FILE_CHUNK_MAGIC = b"UPFC"
+FILE_CHUNK_HEADER = struct.Struct("!4sIIQQIH32s")
+_NO_FILE_HASH = bytes(32)
+# 小文件合并帧: magic + 若干个 (4字节长度 + 文件块帧)，一次加密/发送多个小文件
+FILE_BUNDLE_MAGIC = b"UPFB"
+FILE_BUNDLE_LEN = struct.Struct("!I")
+LEGACY_HASH_HEX_LEN = 32 # Older peers send MD5 file hashes; BLAKE3 hex digests are 64 chars
+
+def _blake3_file(file_path):
+    return blake3.blake3(max_threads=blake3.blake3.AUTO).update_mmap(file_path).hexdigest()
+
+@functools.lru_cache(maxsize=256)
+def _cached_file_hash(file_path, size, mtime_ns):
+    # size/mtime_ns are part of the key so a modified file is rehashed
+    return _blake3_file(file_path)
 
 class ClipMessage:
     """剪贴板消息格式化工具"""
@@ -24,10 +75,10 @@ class ClipMessage:
         }
     
     @staticmethod
-    def file_message(file_paths):
+    def file_message(file_paths, file_hashes=None):
         """创建文件路径消息
         
-        file_paths 可以是单个路径或路径列表
+        file_paths 可以是单个路径或路径列表; file_hashes 为调用方已计算的 {路径: 哈希} (可选)
         """
         if not isinstance(file_paths, list):
             file_paths = [file_paths]
@@ -35,21 +86,27 @@ class ClipMessage:
         file_infos = []
         for path in file_paths:
             path_obj = Path(path)
-            if path_obj.exists():
-                # 计算文件哈希
+            try:
+                st = path_obj.stat()
+            except OSError:
+                continue # 文件不存在
+            # 计算文件哈希
+            file_hash = file_hashes.get(path) if file_hashes else None
+            if file_hash is None:
                 file_hash = ClipMessage.calculate_file_hash(str(path_obj))
-                
-                file_infos.append({
-                    "filename": path_obj.name,
-                    "path": str(path_obj),
-                    "size": path_obj.stat().st_size,
-                    "mtime": path_obj.stat().st_mtime,
-                    "hash": file_hash  # 添加文件哈希
-                })
+
+            file_infos.append({
+                "filename": path_obj.name,
+                "path": str(path_obj),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "hash": file_hash  # 添加文件哈希
+            })
         
         return {
             "type": MessageType.FILE,
-            "files": file_infos
+            "files": file_infos,
+            "batch_requests": True  # 本端支持 FILE_REQUEST_BATCH (旧版本对端不发送此字段)
         }
     
     @staticmethod
@@ -59,20 +116,48 @@ class ClipMessage:
         return {
             "type": MessageType.FILE_REQUEST,
             "filename": path_obj.name,
-            "path": str(path_obj)
+            "path": str(path_obj),
+            "binary_chunks": True  # 本端可接收二进制文件块帧 (旧版本对端不发送此字段，只能接收 JSON 文件块)
         }
     
+    @staticmethod
+    def file_request_batch_message(file_paths):
+        """在一条消息中请求多个文件内容"""
+        return {
+            "type": MessageType.FILE_REQUEST_BATCH,
+            "paths": [str(path) for path in file_paths],
+            "binary_chunks": True
+        }
+
+    @staticmethod
+    def legacy_file_chunk_message(filename, chunk_index, total_chunks, chunk_data, file_hash=None):
+        """旧版 JSON+base64 文件块消息，发给不支持二进制帧的对端 (file_hash 须为MD5，仅随第一块发送)"""
+        return {
+            "type": MessageType.FILE_RESPONSE,
+            "filename": filename,
+            "exists": True,
+            "chunk_data": b64encode_str(chunk_data),
+            "chunk_index": chunk_index,
+            "total_chunks": total_chunks,
+            "file_hash": file_hash
+        }
+
+    @staticmethod
+    def file_unavailable_message(file_path):
+        """请求的文件不存在或不是普通文件时的响应"""
+        return {
+            "type": MessageType.FILE_RESPONSE,
+            "filename": Path(file_path).name,
+            "exists": False
+        }
+
     @staticmethod
     def file_response_message(file_path, chunk_index=0, total_chunks=1):
         """文件内容响应消息"""
         path_obj = Path(file_path)
         
         if not path_obj.exists():
-            return {
-                "type": MessageType.FILE_RESPONSE,
-                "filename": path_obj.name,
-                "exists": False
-            }
+            return ClipMessage.file_unavailable_message(path_obj)
         
         # 计算文件分块
         file_size = path_obj.stat().st_size
@@ -88,10 +173,7 @@ class ClipMessage:
         with open(file_path, "rb") as f:
             f.seek(chunk_size * chunk_index)
             chunk_data = f.read(chunk_size)
-            encoded_data = base64.b64encode(chunk_data).decode('utf-8')
-        
-        # 计算块哈希
-        chunk_hash = hashlib.md5(chunk_data).hexdigest()
+            encoded_data = b64encode_str(chunk_data)
         
         return {
             "type": MessageType.FILE_RESPONSE,
@@ -102,31 +184,145 @@ class ClipMessage:
             "chunk_index": chunk_index,
             "total_chunks": total_chunks,
             "chunk_data": encoded_data,
-            "file_hash": file_hash,  # 完整文件哈希
-            "chunk_hash": chunk_hash  # 当前块哈希
+            "file_hash": file_hash  # 完整文件哈希 (块完整性由 AES-GCM 标签保证)
         }
     
     @staticmethod
-    def calculate_file_hash(file_path):
-        """计算文件的MD5哈希值"""
-        hasher = hashlib.md5()
-        with open(file_path, "rb") as f:
-            # 读取文件块并更新哈希
-            chunk = f.read(65536)  # 64KB 块
-            while chunk:
-                hasher.update(chunk)
-                chunk = f.read(65536)
-        return hasher.hexdigest()
+    def file_chunk_frame(filename, chunk_index, total_chunks, file_size, offset, chunk_data, file_hash=None):
+        """创建二进制文件块帧 (filename 可传入预先编码的 bytes; file_hash 为十六进制字符串，仅需随第一块发送)"""
+        name_bytes = filename if isinstance(filename, bytes) else filename.encode('utf-8')
+        header = FILE_CHUNK_HEADER.pack(
+            FILE_CHUNK_MAGIC, chunk_index, total_chunks, file_size, offset,
+            len(chunk_data), len(name_bytes),
+            bytes.fromhex(file_hash) if file_hash else _NO_FILE_HASH
+        )
+        return b"".join((header, name_bytes, chunk_data)) # Single copy of the chunk payload
+
+    @staticmethod
+    def pack_file_chunk_header(buffer, name_bytes, chunk_index, total_chunks, file_size, offset, chunk_len, file_hash=None):
+        """
+        在 buffer 开头写入文件块帧头和文件名，块数据须已读入其后 (FILE_CHUNK_HEADER.size + len(name_bytes) 处).
+        用于直接把文件读入帧缓冲区，省去一次块数据复制. 返回帧总长度.
+        """
+        FILE_CHUNK_HEADER.pack_into(
+            buffer, 0, FILE_CHUNK_MAGIC, chunk_index, total_chunks, file_size, offset,
+            chunk_len, len(name_bytes),
+            bytes.fromhex(file_hash) if file_hash else _NO_FILE_HASH
+        )
+        name_end = FILE_CHUNK_HEADER.size + len(name_bytes)
+        buffer[FILE_CHUNK_HEADER.size:name_end] = name_bytes
+        return name_end + chunk_len
+
+    @staticmethod
+    def is_file_chunk(data):
+        """判断解密后的数据是否为二进制文件块帧"""
+        return data[:len(FILE_CHUNK_MAGIC)] == FILE_CHUNK_MAGIC # Also works on memoryview
+
+    @staticmethod
+    def parse_file_chunk(data):
+        """解析二进制文件块帧，返回与文件块消息相同结构的字典 (chunk_data 为 memoryview)"""
+        (_, chunk_index, total_chunks, file_size, offset,
+         chunk_len, name_len, file_hash) = FILE_CHUNK_HEADER.unpack_from(data)
+        view = memoryview(data)
+        name_end = FILE_CHUNK_HEADER.size + name_len
+        if name_end + chunk_len > len(view):
+            raise ValueError("文件块帧长度不完整")
+        return {
+            "type": MessageType.FILE_CHUNK,
+            "filename": str(view[FILE_CHUNK_HEADER.size:name_end], 'utf-8'),
+            "chunk_index": chunk_index,
+            "total_chunks": total_chunks,
+            "file_size": file_size,
+            "offset": offset,
+            "chunk_data": view[name_end:name_end + chunk_len],
+            "file_hash": file_hash.hex() if file_hash != _NO_FILE_HASH else None
+        }
+
+    @staticmethod
+    def file_bundle_frame(frames):
+        """将多个文件块帧合并为一个帧"""
+        parts = [FILE_BUNDLE_MAGIC]
+        for frame in frames:
+            parts.append(FILE_BUNDLE_LEN.pack(len(frame)))
+            parts.append(frame)
+        return b"".join(parts)
+
+    @staticmethod
+    def is_file_bundle(data):
+        """判断解密后的数据是否为小文件合并帧"""
+        return data[:len(FILE_BUNDLE_MAGIC)] == FILE_BUNDLE_MAGIC
+
+    @staticmethod
+    def parse_file_bundle(data):
+        """解析小文件合并帧，chunks 为各文件块帧的解析结果"""
+        view = memoryview(data)
+        pos = len(FILE_BUNDLE_MAGIC)
+        chunks = []
+        while pos < len(view):
+            (frame_len,) = FILE_BUNDLE_LEN.unpack_from(view, pos)
+            pos += FILE_BUNDLE_LEN.size
+            if pos + frame_len > len(view):
+                raise ValueError("文件合并帧长度不完整")
+            chunks.append(ClipMessage.parse_file_chunk(view[pos:pos + frame_len]))
+            pos += frame_len
+        return {
+            "type": MessageType.FILE_BUNDLE,
+            "chunks": chunks
+        }
+
+    @staticmethod
+    def calculate_legacy_file_hash(file_path):
+        """计算文件的MD5哈希值 (旧版对端使用的文件哈希算法)"""
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size: # Empty files cannot be mapped
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    md5.update(mm)
+        return md5.hexdigest()
+
+    @staticmethod
+    def new_file_hasher(expected_hash=None):
+        """返回与 expected_hash 算法一致的增量哈希对象 (无预期哈希时为BLAKE3)"""
+        if expected_hash and len(expected_hash) == LEGACY_HASH_HEX_LEN:
+            return hashlib.md5()
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+    @staticmethod
+    def hash_file_like(file_path, expected_hash):
+        """用与 expected_hash 相同的算法计算文件哈希: 32位十六进制为旧版MD5，否则为BLAKE3"""
+        if len(expected_hash) == LEGACY_HASH_HEX_LEN:
+            return ClipMessage.calculate_legacy_file_hash(file_path)
+        return ClipMessage.calculate_file_hash(file_path, cached=False)
+
+    @staticmethod
+    def calculate_file_hash(file_path, cached=True, st=None):
+        """计算文件的BLAKE3哈希值 (通过 mmap 读取，大文件自动多线程并行哈希)
+
+        默认按 (路径, 大小, mtime_ns) 缓存结果，同一文件在文件信息消息和传输中只读取一次;
+        校验刚写入的文件时应传入 cached=False. st: 调用方已取得的 os.stat 结果 (可选).
+        """
+        file_path = str(file_path)
+        if not cached:
+            return _blake3_file(file_path)
+        if st is None:
+            st = os.stat(file_path)
+        return _cached_file_hash(file_path, st.st_size, st.st_mtime_ns)
     
     @staticmethod
     def serialize(message):
-        """序列化消息为JSON字符串"""
-        return json.dumps(message)
+        """序列化消息为UTF-8编码的JSON字节串 (可直接加密发送)"""
+        if HAS_ORJSON:
+            return orjson.dumps(message)
+        return json.dumps(message).encode('utf-8')
     
     @staticmethod
-    def deserialize(json_str):
-        """反序列化JSON字符串为消息"""
+    def deserialize(json_data):
+        """反序列化JSON字符串或字节串 (含 memoryview) 为消息"""
         try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
+            if HAS_ORJSON:
+                return orjson.loads(json_data)
+            if isinstance(json_data, memoryview):
+                json_data = json_data.tobytes()
+            return json.loads(json_data)
+        except ValueError: # JSONDecodeError / UnicodeDecodeError
             return None
\ No newline at end of file
@@ -3,11 +3,10 @@ Common message handling utilities for UniPaste
 Provides shared functionality for processing different message types
 """
 
-import json
 import time
 from typing import Callable, Optional
 
-from utils.message_format import MessageType
+from utils.message_format import ClipMessage, MessageType
 
 
 class MessageHandler:
@@ -34,8 +33,12 @@ class MessageHandler:
         try:
             # Decrypt the message
             decrypted_data = security_mgr.decrypt_message(encrypted_data)
-            message_json = decrypted_data.decode('utf-8')
-            message = json.loads(message_json)
+            if ClipMessage.is_file_chunk(decrypted_data):
+                message = ClipMessage.parse_file_chunk(decrypted_data)
+            elif ClipMessage.is_file_bundle(decrypted_data):
+                message = ClipMessage.parse_file_bundle(decrypted_data) # Several small files in one frame
+            else:
+                message = ClipMessage.deserialize(decrypted_data) # None if not valid JSON
             
             if not message or "type" not in message:
                 print("⚠️ 收到的消息格式无效或无法解析")
@@ -55,12 +58,6 @@ class MessageHandler:
                 print(f"⚠️ 未知消息类型: {msg_type}")
                 return False
                 
-        except json.JSONDecodeError:
-            print("❌ 收到的消息不是有效的JSON")
-            return False
-        except UnicodeDecodeError:
-            print("❌ 无法将收到的消息解码为UTF-8")
-            return False
         except Exception as e:
             print(f"❌ 处理接收数据时出错: {e}")
             return False
@@ -83,8 +80,7 @@ class MessageHandler:
     ):
         """Send an encrypted message"""
         try:
-            message_json = json.dumps(message)
-            encrypted_data = security_mgr.encrypt_message(message_json.encode('utf-8'))
+            encrypted_data = await security_mgr.encrypt_message_async(ClipMessage.serialize(message))
             await websocket.send(encrypted_data)
             return True
         except Exception as e:
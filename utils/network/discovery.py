@@ -3,7 +3,7 @@ import json
 from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo, ServiceListener
 import netifaces
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
 
 class ClipboardServiceListener(ServiceListener):
     def __init__(self, callback):
@@ -24,12 +24,21 @@ class ClipboardServiceListener(ServiceListener):
         pass
 
 class DeviceDiscovery:
+    LOCAL_IP_RECHECK_INTERVAL = 60.0 # Seconds between interface-list checks for a cached local IP
+
     def __init__(self, service_name="_clipshare._tcp.local."):
         self.zeroconf = Zeroconf()
         self.service_name = service_name
         self.discovered_devices = {}
-        self._executor = ThreadPoolExecutor(max_workers=1)
         self.browser = None # Initialize browser attribute
+        self._local_ip = None
+        self._local_ip_packed = None
+        self._local_ip_checked_at = 0.0
+        self._interfaces_signature = None
+        # Fixed for the process lifetime: resolve once instead of per advertise
+        self._hostname = socket.gethostname()
+        self._instance_name = f"Device_{self._hostname}.{self.service_name}"
+        self._get_local_ip()
 
     async def start_advertising(self, port):
         """Advertise this device on the network."""
@@ -38,17 +47,16 @@ class DeviceDiscovery:
         
         info = ServiceInfo(
             self.service_name,
-            f"Device_{socket.gethostname()}.{self.service_name}",
-            addresses=[socket.inet_aton(ip_addr)],
+            self._instance_name,
+            addresses=[self._local_ip_packed],
             port=port,
             properties={},
         )
         
         print(f"📢 广播服务: {self.service_name}")
-        print(f"📛 服务名称: Device_{socket.gethostname()}.{self.service_name}")
+        print(f"📛 服务名称: {self._instance_name}")
         
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(self._executor, self.zeroconf.register_service, info)
+        await asyncio.to_thread(self.zeroconf.register_service, info)
         print("✅ 服务注册成功")
 
     def start_discovery(self, callback):
@@ -76,23 +84,42 @@ class DeviceDiscovery:
                  self.browser = None
 
     def _get_local_ip(self):
-        """Get the local IP address."""
-        for interface in netifaces.interfaces():
-            addrs = netifaces.ifaddresses(interface)
-            if netifaces.AF_INET in addrs:
-                for addr in addrs[netifaces.AF_INET]:
+        """Get the local IP address (cached, revalidated against the interface list at most once a minute)."""
+        now = time.monotonic()
+        if self._local_ip and now - self._local_ip_checked_at < self.LOCAL_IP_RECHECK_INTERVAL:
+            return self._local_ip
+
+        signature = tuple(netifaces.interfaces())
+        if self._local_ip is None or signature != self._interfaces_signature:
+            self._local_ip = self._probe_local_ip()
+            self._local_ip_packed = socket.inet_aton(self._local_ip)
+            self._interfaces_signature = signature
+        self._local_ip_checked_at = now
+        return self._local_ip
+
+    @staticmethod
+    def _probe_local_ip():
+        """Find the address of the default-route interface with a single UDP connect (no packet is sent)."""
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+        except OSError:
+            # No route available: fall back to the first non-loopback IPv4 address
+            for interface in netifaces.interfaces():
+                for addr in netifaces.ifaddresses(interface).get(netifaces.AF_INET, ()):
                     if addr['addr'] != '127.0.0.1':
                         return addr['addr']
-        return '127.0.0.1'
+            return '127.0.0.1'
+        finally:
+            s.close()
 
     def close(self):
         """Clean up resources, including Zeroconf instance."""
-        print("DEBUG: Closing DeviceDiscovery (Zeroconf and Executor).")
+        print("DEBUG: Closing DeviceDiscovery (Zeroconf).")
         self.stop_browser() # Ensure browser is stopped
         if hasattr(self, 'zeroconf'):
             try:
                 self.zeroconf.close()
             except Exception as e:
                  print(f"⚠️ Error closing zeroconf: {e}")
-        if hasattr(self, '_executor'):
-            self._executor.shutdown(wait=False) # Don't wait indefinitely
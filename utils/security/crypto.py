@@ -1,16 +1,34 @@
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import asyncio
+import itertools
+import logging
 import os
 import base64
 import json
+from config import ClipboardConfig
+
+log = logging.getLogger(__name__)
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+HAS_ENCRYPT_INTO = hasattr(AESGCM, "encrypt_into") # cryptography >= 44: encrypt straight into a caller buffer
+HAS_DECRYPT_INTO = hasattr(AESGCM, "decrypt_into")
 
 class SecurityManager:
+    PASSWORD_KDF_SALT = b'clipshare-password-key-v1' # Fixed app salt: both peers must derive the same key
+    _password_key_cache = {} # sha256(password) -> derived key, shared across instances
+
     def __init__(self):
         self.private_key = None
         self.public_key = None
         self.shared_key = None
+        self._aesgcm = None # Cipher bound to shared_key, built once per key
+        self._nonce_prefix = None
+        self._nonce_counter = None
 
     def generate_key_pair(self):
         """Generate new ECDH key pair"""
@@ -22,6 +40,15 @@ class SecurityManager:
             print(f"密钥对生成失败: {e}")
             raise
 
+    def _set_shared_key(self, key: bytes):
+        """Install a new shared key and the AES-GCM cipher bound to it"""
+        self.shared_key = key
+        self._aesgcm = AESGCM(key)
+        # Nonce = random 4-byte prefix + 64-bit counter from a random start, re-seeded per key.
+        # Both peers encrypt under the same key, so neither part may start at a fixed value.
+        self._nonce_prefix = os.urandom(4)
+        self._nonce_counter = itertools.count(int.from_bytes(os.urandom(8), 'big')) # next() is atomic under the GIL
+
     def has_shared_key(self):
         """Check if shared key exists"""
         return self.shared_key is not None
@@ -54,44 +81,79 @@ class SecurityManager:
             raise ValueError("No private key available")
             
         shared_key = self.private_key.exchange(ec.ECDH(), peer_public_key)
-        self.shared_key = HKDF(
+        self._set_shared_key(HKDF(
             algorithm=hashes.SHA256(),
             length=32,
             salt=None,
             info=b'handshake data',
-        ).derive(shared_key)
-        print(f"🔑 ECDH密钥交换成功，前8字节: {self.shared_key[:8].hex()}")
+        ).derive(shared_key))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("🔑 ECDH密钥交换成功，前8字节: %s", self.shared_key[:8].hex())
         return self.shared_key
 
     def set_shared_key_from_password(self, password: str):
-        """Set shared key from a password (for testing)"""
+        """Set shared key from a password (for testing), derived with scrypt and memoized"""
         import hashlib
-        self.shared_key = hashlib.sha256(password.encode()).digest()
-        print(f"🔑 从密码设置密钥，前8字节: {self.shared_key[:8].hex()}")
+        password_bytes = password.encode()
+        cache_key = hashlib.sha256(password_bytes).digest()
+        key = self._password_key_cache.get(cache_key)
+        if key is None:
+            key = Scrypt(salt=self.PASSWORD_KDF_SALT, length=32, n=2**14, r=8, p=1).derive(password_bytes)
+            self._password_key_cache[cache_key] = key
+        self._set_shared_key(key)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("🔑 从密码设置密钥，前8字节: %s", self.shared_key[:8].hex())
         return self.shared_key
 
-    def encrypt_message(self, message: bytes) -> bytes:
+    def encrypt_message(self, message: bytes) -> bytes | bytearray:
         """Encrypt a message using AES-256-GCM."""
         if not self.shared_key:
             raise ValueError("Shared key not established")
         
         try:
-            aesgcm = AESGCM(self.shared_key)
-            nonce = os.urandom(12)
-            ciphertext = aesgcm.encrypt(nonce, message, None)
-            encrypted = nonce + ciphertext
+            nonce = self._nonce_prefix + (next(self._nonce_counter) & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'big')
+            if not HAS_ENCRYPT_INTO:
+                return nonce + self._aesgcm.encrypt(nonce, message, None)
+            # Encrypt directly behind the nonce: one output allocation, no nonce+ciphertext copy
+            encrypted = bytearray(NONCE_SIZE + len(message) + TAG_SIZE)
+            encrypted[:NONCE_SIZE] = nonce
+            with memoryview(encrypted) as view:
+                self._aesgcm.encrypt_into(nonce, message, None, view[NONCE_SIZE:])
             return encrypted
         except Exception as e:
-            print(f"❌ 加密失败: {e}")
+            log.error("❌ 加密失败: %s", e)
             raise
 
+    def encrypt_message_into(self, message, buffer: bytearray):
+        """Encrypt into a reused caller buffer and return a memoryview, falling back to encrypt_message when it does not fit."""
+        size = NONCE_SIZE + len(message) + TAG_SIZE
+        if not HAS_ENCRYPT_INTO or size > len(buffer):
+            return self.encrypt_message(message)
+        if not self.shared_key:
+            raise ValueError("Shared key not established")
+        try:
+            nonce = self._nonce_prefix + (next(self._nonce_counter) & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'big')
+            encrypted = memoryview(buffer)[:size]
+            encrypted[:NONCE_SIZE] = nonce
+            self._aesgcm.encrypt_into(nonce, message, None, encrypted[NONCE_SIZE:])
+            return encrypted
+        except Exception as e:
+            log.error("❌ 加密失败: %s", e)
+            raise
+
+    async def encrypt_message_async(self, message: bytes) -> bytes | bytearray:
+        """Encrypt a message, running large payloads in a worker thread so the event loop stays responsive."""
+        if len(message) < ClipboardConfig.CRYPTO_THREAD_THRESHOLD:
+            return self.encrypt_message(message)
+        return await asyncio.to_thread(self.encrypt_message, message)
+
     def decrypt_message(self, encrypted_data):
         """Decrypt a message using AES-256-GCM."""
         if not self.shared_key:
             raise ValueError("Shared key not established")
         
         # 确保数据是二进制格式
-        if not isinstance(encrypted_data, bytes):
+        if not isinstance(encrypted_data, (bytes, bytearray, memoryview)):
             try:
                 if isinstance(encrypted_data, str):
                     if encrypted_data.startswith('{'):
@@ -101,26 +163,39 @@ class SecurityManager:
                 else:
                     raise TypeError(f"无法处理的数据类型: {type(encrypted_data)}")
             except Exception as e:
-                print(f"❌ 数据类型转换失败: {e}")
+                log.error("❌ 数据类型转换失败: %s", e)
                 raise
         
         try:
             # 检查数据格式
-            if len(encrypted_data) <= 12:
+            if len(encrypted_data) <= NONCE_SIZE:
                 raise ValueError(f"数据太短: {len(encrypted_data)} 字节")
                 
-            # 提取nonce和密文
-            nonce = encrypted_data[:12]
-            ciphertext = encrypted_data[12:]
-            
-            aesgcm = AESGCM(self.shared_key)
-            decrypted_data = aesgcm.decrypt(nonce, ciphertext, None)
+            # 提取nonce和密文 (memoryview 切片，避免复制整个密文)
+            view = memoryview(encrypted_data)
+            decrypted_data = self._aesgcm.decrypt(view[:NONCE_SIZE], view[NONCE_SIZE:], None)
             
             return decrypted_data
         except Exception as e:
-            print(f"❌ 解密失败: {e}")
-            print(f"数据长度: {len(encrypted_data)} 字节")
-            print(f"数据预览 (十六进制): {encrypted_data[:20].hex()}")
+            log.error("❌ 解密失败: %s (数据长度: %d 字节)", e, len(encrypted_data))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("数据预览 (十六进制): %s", encrypted_data[:20].hex())
+            raise
+
+    def decrypt_message_into(self, encrypted_data, buffer: bytearray):
+        """Decrypt into a reused caller buffer and return a memoryview, falling back to decrypt_message when it does not fit."""
+        size = len(encrypted_data) - NONCE_SIZE - TAG_SIZE
+        if not HAS_DECRYPT_INTO or not isinstance(encrypted_data, bytes) or not 0 < size <= len(buffer):
+            return self.decrypt_message(encrypted_data)
+        if not self.shared_key:
+            raise ValueError("Shared key not established")
+        try:
+            view = memoryview(encrypted_data)
+            plaintext = memoryview(buffer)[:size]
+            self._aesgcm.decrypt_into(view[:NONCE_SIZE], view[NONCE_SIZE:], None, plaintext)
+            return plaintext
+        except Exception as e:
+            log.error("❌ 解密失败: %s (数据长度: %d 字节)", e, len(encrypted_data))
             raise
 
     async def perform_key_exchange(self, send_data_func, receive_data_func):
@@ -7,6 +7,7 @@ import hmac
 import hashlib
 import sys
 import base64
+import logging
 import time
 from pathlib import Path
 from utils.security.crypto import SecurityManager
@@ -21,6 +22,8 @@ from config import ClipboardConfig
 import tempfile
 import traceback # Import traceback
 
+log = logging.getLogger(__name__)
+
 # Verify platform at startup
 verify_platform('windows')
 
@@ -70,6 +73,7 @@ class WindowsClipboardClient:
         self.connection_status = ConnectionStatus.DISCONNECTED
         self.reconnect_delay = 3
         self.max_reconnect_delay = 30
+        self.server_binary_chunks = False # Server accepts binary file chunk frames (advertised at authentication)
         self.last_discovery_time = 0
         self.last_content_hash = None # Hash of last content *sent* or *set* by this client
         self.last_update_time = 0 # Timestamp of last update *initiated* by this client
@@ -79,6 +83,7 @@ class WindowsClipboardClient:
         self.last_remote_update_time = 0 # Timestamp of last *received* remote update
         self.ignore_clipboard_until = 0 # Timestamp until which local clipboard changes are ignored
         self._last_processed_content = None # Store last successfully processed text content
+        self.last_clipboard_seq = None # Clipboard sequence number seen by the last check
 
         # Initialize file handler
         self.file_handler = FileHandler(
@@ -291,7 +296,9 @@ class WindowsClipboardClient:
         async with websockets.connect(
             self.ws_url,
             subprotocols=["binary"],
-            max_size= 10 * 1024 * 1024, # Allow larger messages (e.g., 10MB) for file chunks
+            max_size=ClipboardConfig.MAX_MESSAGE_SIZE, # Allow large messages for file chunks
+            compression=None, # Payloads are AES-GCM ciphertext: deflate only burns CPU and copies
+            write_limit=ClipboardConfig.WRITE_BUFFER_LIMIT, # Keep the socket busy across chunk boundaries
             ping_interval=20,
             ping_timeout=20
         ) as websocket:
@@ -372,6 +379,7 @@ class WindowsClipboardClient:
 
             response_data = json.loads(auth_response)
             status = response_data.get('status')
+            self.server_binary_chunks = bool(response_data.get('binary_chunks')) # Older servers omit it
 
             if status == 'authorized':
                 print(f"✅ 身份验证成功! 服务器: {response_data.get('server_id', '未知')}")
@@ -436,14 +444,24 @@ class WindowsClipboardClient:
                  traceback.print_exc()
         return None # Return None if no files or error
 
+    def _clipboard_changed(self):
+        """通过剪贴板序列号判断剪贴板是否变化 (无需打开剪贴板)"""
+        try:
+            seq = win32clipboard.GetClipboardSequenceNumber()
+        except Exception:
+            return True # Fall back to reading the clipboard every interval
+        if seq == self.last_clipboard_seq:
+            return False
+        self.last_clipboard_seq = seq
+        return True
+
     # Removed _set_clipboard_file_paths (logic moved to _handle_file_response)
     # Removed _normalize_path (Path() handles this)
 
-    async def _send_encrypted(self, data: bytes, websocket):
-        """Helper to encrypt and send data via the websocket."""
+    async def _send_encrypted(self, data: bytes, websocket, encrypted: bool = False):
+        """Helper to encrypt and send data via the websocket (encrypted=True: data is already encrypted)."""
         try:
-            encrypted = self.security_mgr.encrypt_message(data)
-            await websocket.send(encrypted)
+            await websocket.send(data if encrypted else await self.security_mgr.encrypt_message_async(data))
         except websockets.exceptions.ConnectionClosed:
              print("❌ 发送数据失败：连接已关闭")
              self.connection_status = ConnectionStatus.DISCONNECTED # Update status
@@ -461,8 +479,8 @@ class WindowsClipboardClient:
         last_send_attempt_time = 0
 
         # Wrapper function for FileHandler
-        async def send_encrypted_wrapper(data_to_encrypt: bytes):
-            await self._send_encrypted(data_to_encrypt, websocket)
+        async def send_encrypted_wrapper(data_to_encrypt: bytes, encrypted: bool = False):
+            await self._send_encrypted(data_to_encrypt, websocket, encrypted)
 
         while self.running and self.connection_status == ConnectionStatus.CONNECTED:
             try:
@@ -475,22 +493,28 @@ class WindowsClipboardClient:
 
                 # Ignore if we recently updated the clipboard locally
                 if current_time < self.ignore_clipboard_until:
-                    await asyncio.sleep(0.1)
+                    await asyncio.sleep(self.ignore_clipboard_until - current_time) # Sleep until the ignore window ends
                     continue
 
                 # Limit check frequency
-                if current_time - last_send_attempt_time < ClipboardConfig.CLIPBOARD_CHECK_INTERVAL:
-                    await asyncio.sleep(0.1)
+                next_check_time = last_send_attempt_time + ClipboardConfig.CLIPBOARD_CHECK_INTERVAL
+                if current_time < next_check_time:
+                    await asyncio.sleep(next_check_time - current_time)
                     continue
 
                 last_send_attempt_time = current_time
                 sent_update_this_cycle = False
 
+                # Skip the (expensive) clipboard read if Windows reports no change
+                if not self._clipboard_changed():
+                    await asyncio.sleep(ClipboardConfig.CLIPBOARD_CHECK_INTERVAL)
+                    continue
+
                 # --- Check for Files ---
                 file_paths = self._get_clipboard_file_paths()
                 if file_paths:
                     # Calculate hash of current file paths *content*
-                    content_hash = self.file_handler.get_files_content_hash(file_paths)
+                    content_hash = await asyncio.to_thread(self.file_handler.get_files_content_hash, file_paths)
 
                     # Check if content hash is valid and different from last sent hash
                     if content_hash and content_hash != self.last_content_hash:
@@ -508,10 +532,10 @@ class WindowsClipboardClient:
                             # Initiate file transfer after sending info
                             print("🔄 准备主动传输文件内容...")
                             try:
-                                for file_path in file_paths:
-                                    await self.file_handler.handle_file_transfer(
-                                        file_path, send_encrypted_wrapper # Pass wrapper
-                                    )
+                                await self.file_handler.handle_files_transfer(
+                                    file_paths, send_encrypted_wrapper, # Pass wrapper
+                                    binary_chunks=self.server_binary_chunks
+                                )
                             except Exception as transfer_err:
                                  print(f"❌ 文件传输过程中断: {transfer_err}")
                                  # Connection status likely updated in _send_encrypted
@@ -533,7 +557,7 @@ class WindowsClipboardClient:
                 # Process only if text content exists and is different from last processed
                 if current_content and current_content != self._last_processed_content:
                     # Anti-loop check: Compare with last received remote hash
-                    content_hash = hashlib.md5(current_content.encode()).hexdigest()
+                    content_hash = self.file_handler.text_hash(current_content)
                     if (self.last_remote_content_hash == content_hash and
                         current_time - self.last_remote_update_time < ClipboardConfig.UPDATE_DELAY * 2):
                         # print("⏭️ 跳过发送回环文本内容") # Less verbose
@@ -547,7 +571,8 @@ class WindowsClipboardClient:
                             current_time,
                             self.last_content_hash,
                             self.last_update_time,
-                            send_encrypted_wrapper # Pass the wrapper
+                            send_encrypted_wrapper, # Pass the wrapper
+                            content_hash=content_hash # Already computed for the anti-loop check
                         )
                         if update_sent:
                             self.last_content_hash = new_hash
@@ -578,9 +603,10 @@ class WindowsClipboardClient:
     async def receive_clipboard_changes(self, websocket):
         """接收来自服务器的剪贴板变化"""
         # Wrapper function for FileHandler to send requests back to server
-        async def send_encrypted_wrapper(data_to_encrypt: bytes):
-            await self._send_encrypted(data_to_encrypt, websocket)
+        async def send_encrypted_wrapper(data_to_encrypt: bytes, encrypted: bool = False):
+            await self._send_encrypted(data_to_encrypt, websocket, encrypted)
 
+        recv_buffer = bytearray(ClipboardConfig.RECV_BUFFER_SIZE) # Reused for every decrypted message on this connection
         while self.running and self.connection_status == ConnectionStatus.CONNECTED:
             try:
                 # Receive data with timeout
@@ -588,16 +614,20 @@ class WindowsClipboardClient:
                 self.is_receiving = True # Set flag
 
                 # Decrypt and process
-                decrypted_data = self.security_mgr.decrypt_message(received_data)
-                message_json = decrypted_data.decode('utf-8')
-                message = ClipMessage.deserialize(message_json)
+                decrypted_data = self.security_mgr.decrypt_message_into(received_data, recv_buffer)
+                if ClipMessage.is_file_chunk(decrypted_data):
+                    message = ClipMessage.parse_file_chunk(decrypted_data) # Binary file chunk frame
+                elif ClipMessage.is_file_bundle(decrypted_data):
+                    message = ClipMessage.parse_file_bundle(decrypted_data) # Several small files in one frame
+                else:
+                    message = ClipMessage.deserialize(decrypted_data)
 
                 if not message or "type" not in message:
                      print("⚠️ 收到的消息格式无效或无法解析")
                      continue # Skip this message
 
                 msg_type = message["type"]
-                print(f"📬 收到消息类型: {msg_type}")
+                log.debug("📬 收到消息类型: %s", msg_type) # Per message (every file chunk): debug only
 
                 if msg_type == MessageType.TEXT:
                     await self._handle_text_message(message)
@@ -606,21 +636,32 @@ class WindowsClipboardClient:
                     await self.file_handler.handle_received_files(
                          message, send_encrypted_wrapper, sender_websocket=websocket
                     )
-                elif msg_type == MessageType.FILE_RESPONSE:
+                elif msg_type in (MessageType.FILE_CHUNK, MessageType.FILE_RESPONSE):
                     # Handle incoming file chunk
                     await self._handle_file_response(message)
-                elif msg_type == MessageType.FILE_REQUEST:
-                     # Server is requesting a file from us
-                     file_path_requested = message.get("path")
-                     if file_path_requested:
-                          print(f"📤 收到文件请求: {Path(file_path_requested).name}")
-                          # Send file chunks back to server via wrapper
-                          await self.file_handler.handle_file_transfer(
-                               file_path_requested,
-                               send_encrypted_wrapper
-                          )
+                elif msg_type == MessageType.FILE_BUNDLE:
+                    # Several small files, each a complete single-chunk transfer
+                    for chunk in message["chunks"]:
+                        await self._handle_file_response(chunk)
+                elif msg_type in (MessageType.FILE_REQUEST, MessageType.FILE_REQUEST_BATCH):
+                     # Server is requesting one file (or a batch of files) from us
+                     if msg_type == MessageType.FILE_REQUEST:
+                          paths_requested = [message.get("path")]
                      else:
+                          paths_requested = message.get("paths") or []
+                     if not all(paths_requested):
                           print("⚠️ 收到的文件请求缺少路径")
+                     paths_requested = [path for path in paths_requested if path]
+                     for file_path_requested in paths_requested:
+                          print(f"📤 收到文件请求: {Path(file_path_requested).name}")
+                     # Send file chunks back to server via wrapper (batch requesters understand bundles)
+                     await self.file_handler.handle_files_transfer(
+                          paths_requested,
+                          send_encrypted_wrapper,
+                          bundle=msg_type == MessageType.FILE_REQUEST_BATCH,
+                          # Older peers request without binary_chunks and only understand JSON chunks
+                          binary_chunks=msg_type == MessageType.FILE_REQUEST_BATCH or bool(message.get("binary_chunks"))
+                     )
                 else:
                      print(f"⚠️ 未知消息类型: {msg_type}")
 
@@ -770,7 +811,7 @@ class WindowsClipboardClient:
                 return
 
             # Calculate hash *before* setting clipboard
-            content_hash = hashlib.md5(text.encode()).hexdigest()
+            content_hash = self.file_handler.text_hash(text)
 
             # Check if this content hash was the last one *we* sent or set
             if content_hash == self.last_content_hash:
@@ -871,22 +912,22 @@ class WindowsClipboardClient:
         """处理接收到的文件响应 (块)"""
         try:
             # Use FileHandler to process the chunk
-            is_complete, completed_path = self.file_handler.handle_received_chunk(message)
+            is_complete, completed_path = await self.file_handler.handle_received_chunk(message)
 
             # If file transfer is complete
             if is_complete and completed_path:
                 print(f"✅ 文件接收完成: {completed_path}")
 
                 # Calculate hash of the completed file
-                content_hash = self.file_handler.get_files_content_hash([str(completed_path)])
+                content_hash = await asyncio.to_thread(self.file_handler.get_files_content_hash, [str(completed_path)])
 
                 # Check if this file content hash was the last one *we* sent or set
                 if content_hash and content_hash == self.last_content_hash:
                     print("⏭️ 跳过重复文件内容 (与本地最后发送/设置一致)")
                     return # Don't update clipboard
 
-                # Set the completed file to the Windows clipboard
-                if self._set_windows_clipboard_file(completed_path):
+                # Set the completed file to the Windows clipboard (blocking Win32 call, kept off the event loop)
+                if await asyncio.to_thread(self._set_windows_clipboard_file, completed_path):
                      # Update state *after* successful clipboard operation
                      self.last_content_hash = content_hash # Mark this hash as processed locally
                      self.last_update_time = time.time() # Mark time of local update